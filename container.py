@@ -0,0 +1,321 @@
+import os
+import hmac
+import zlib
+import base64
+import codecs
+import hashlib
+import struct
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# binary paper file, version 1:
+#   magic 'PPR' | version (1 byte) | nonce (12 bytes) | AES-GCM ciphertext
+# version 2 replaces the single ciphertext with a sequence of records
+#   length (4 bytes) | nonce (12 bytes) | AES-GCM ciphertext of one chunk
+# each chunk authenticates the prefix, its index and whether it is the
+# last one, so chunks cannot be reordered, dropped or truncated
+# version 3 adds the codec (1 byte), dictionary id (4 bytes) and a random
+# file id (16 bytes) to the prefix, chunks are compressed one by one before
+# encryption. the file id keeps chunks from being moved between papers
+MAGIC = b'PPR'
+VERSION = 3
+PREFIX = MAGIC + bytes([VERSION])
+PREFIX_V1 = MAGIC + bytes([1])
+PREFIX_V2 = MAGIC + bytes([2])
+CODEC_HEAD = struct.Struct('>BI')
+FILE_ID_SIZE = 16
+NONCE_SIZE = 12
+RECORD_HEAD = struct.Struct('>I')
+CHUNK_SIZE = 64 * 1024
+
+CODECS = {'none': 0, 'zlib': 1, 'zstd': 2}
+DICTIONARY_SIZE = 32 * 1024
+
+
+def subkey(key, info):
+    hkdf = HKDF(algorithm=hashes.SHA256(),
+                length=32,
+                salt=None,
+                info=info,
+                backend=default_backend())
+    return hkdf.derive(base64.urlsafe_b64decode(key))
+
+
+def textChunks(text, size=CHUNK_SIZE):
+    # utf-8 encodes text a slice at a time, yielding (data, last) for
+    # chunks of size bytes, an empty text still gives one chunk
+    buf = bytearray()
+    pending = None
+    step = size // 4
+    for i in range(0, len(text), step):
+        buf += text[i:i + step].encode()
+        while len(buf) >= size:
+            if pending is not None:
+                yield pending, False
+            pending = bytes(buf[:size])
+            del buf[:size]
+    if buf or pending is None:
+        if pending is not None:
+            yield pending, False
+        pending = bytes(buf)
+    yield pending, True
+
+
+def chunkDigest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def dictionaryId(zdict):
+    # 0 means no dictionary
+    return int.from_bytes(chunkDigest(zdict)[:4], 'big') or 1
+
+
+def compress(codec, data, zdict=None):
+    if codec == CODECS['zlib']:
+        if zdict:
+            c = zlib.compressobj(zlib.Z_BEST_SPEED, zdict=zdict)
+        else:
+            c = zlib.compressobj(zlib.Z_BEST_SPEED)
+        return c.compress(data) + c.flush()
+    elif codec == CODECS['zstd']:
+        if zstandard is None:
+            raise ValueError("zstd compression is not available")
+        if zdict:
+            c = zstandard.ZstdCompressor(
+                dict_data=zstandard.ZstdCompressionDict(zdict))
+        else:
+            c = zstandard.ZstdCompressor()
+        return c.compress(data)
+    return data
+
+
+def decompress(codec, data, zdict=None):
+    if codec == CODECS['zlib']:
+        if zdict:
+            d = zlib.decompressobj(zdict=zdict)
+        else:
+            d = zlib.decompressobj()
+        return d.decompress(data) + d.flush()
+    elif codec == CODECS['zstd']:
+        if zstandard is None:
+            raise ValueError("zstd compression is not available")
+        if zdict:
+            d = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(zdict))
+        else:
+            d = zstandard.ZstdDecompressor()
+        return d.decompress(data)
+    elif codec != CODECS['none']:
+        raise ValueError("Unknown compression codec")
+    return data
+
+
+def trainDictionary(codec, samples, size=DICTIONARY_SIZE):
+    # samples are the utf-8 bodies of the store's papers
+    if codec == CODECS['zstd'] and zstandard is not None:
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError:
+            # too few samples, fall back to the line based dictionary
+            pass
+
+    # zlib looks back from the end of the dictionary, so the most
+    # frequent lines go last
+    counts = Counter()
+    for i in samples:
+        counts.update(line for line in i.splitlines(True) if len(line) > 3)
+    lines = []
+    total = 0
+    for line, count in counts.most_common():
+        if count < 2 or total + len(line) > size:
+            break
+        lines.append(line)
+        total += len(line)
+    return b''.join(reversed(lines))
+
+
+class PaperCipher:
+
+    def __init__(self, key, codec='zlib'):
+        # key is the store's base64 data key, fernet is kept to read
+        # papers written before the binary format
+        self.fernet = Fernet(key)
+        self.aead = AESGCM(subkey(key, b'paper body'))
+        self.mac_key = subkey(key, b'paper digest')
+        if codec not in CODECS:
+            raise ValueError("Unknown compression codec " + codec)
+        self.codec = CODECS[codec]
+        self.dictionaries = {}
+        self.dictionary = 0
+
+    def addDictionary(self, zdict, active=True):
+        dict_id = dictionaryId(zdict)
+        self.dictionaries[dict_id] = zdict
+        if active:
+            self.dictionary = dict_id
+        return dict_id
+
+    def textDigest(self, text):
+        # keyed hash of the utf-8 text, computed a chunk at a time
+        mac = hmac.new(self.mac_key, digestmod=hashlib.sha256)
+        for data, last in textChunks(text):
+            mac.update(data)
+        return mac.digest()
+
+    def isCurrent(self, data):
+        return memoryview(data)[:len(PREFIX)] == PREFIX
+
+    def parsePrefix(self, view):
+        # returns the prefix of a chunked paper with its codec and
+        # dictionary, or None for the single shot formats
+        if view[:len(PREFIX)] == PREFIX_V2:
+            return PREFIX_V2, CODECS['none'], None
+        if view[:len(PREFIX)] == PREFIX:
+            end = len(PREFIX) + CODEC_HEAD.size + FILE_ID_SIZE
+            if len(view) < end:
+                raise InvalidToken
+            codec, dict_id = CODEC_HEAD.unpack_from(view, len(PREFIX))
+            if dict_id and dict_id not in self.dictionaries:
+                raise ValueError("Missing compression dictionary")
+            return bytes(view[:end]), codec, self.dictionaries.get(dict_id)
+        return None
+
+    def readPrefix(self, f):
+        # parsePrefix for an open file, which is left after the prefix
+        layout = self.parsePrefix(memoryview(f.read(
+            len(PREFIX) + CODEC_HEAD.size + FILE_ID_SIZE)))
+        if layout is not None:
+            f.seek(len(layout[0]))
+        return layout
+
+    def chunkAad(self, prefix, index, last):
+        # the prefix carries the file id of version 3 papers
+        return prefix + struct.pack('>QB', index, last)
+
+    def encryptChunk(self, prefix, index, data, last):
+        nonce = os.urandom(NONCE_SIZE)
+        aad = self.chunkAad(prefix, index, last)
+        ctext = self.aead.encrypt(nonce, data, aad)
+        return RECORD_HEAD.pack(len(ctext)) + nonce + ctext
+
+    def decryptChunk(self, prefix, index, record, last):
+        nonce = record[:NONCE_SIZE]
+        try:
+            return self.aead.decrypt(nonce, record[NONCE_SIZE:],
+                                     self.chunkAad(prefix, index, last))
+        except InvalidTag:
+            raise InvalidToken
+
+    def decrypt(self, data):
+        # single shot formats, data can be any buffer, slicing the view
+        # does not copy it
+        view = memoryview(data)
+        if view[:len(MAGIC)] != MAGIC:
+            return self.fernet.decrypt(bytes(view))
+        if len(view) < len(PREFIX_V1) + NONCE_SIZE or \
+                view[:len(PREFIX_V1)] != PREFIX_V1:
+            raise InvalidToken
+
+        start = len(PREFIX_V1)
+        nonce = view[start:start + NONCE_SIZE]
+        try:
+            return self.aead.decrypt(nonce, view[start + NONCE_SIZE:],
+                                     PREFIX_V1)
+        except InvalidTag:
+            raise InvalidToken
+
+    def readChunks(self, view, prefix, codec, zdict):
+        # yields (offset, plaintext) of each record, records are passed to
+        # the cipher as slices of view
+        offset = len(prefix)
+        end = len(view)
+        index = 0
+        while offset < end:
+            start = offset + RECORD_HEAD.size
+            if start > end:
+                raise InvalidToken
+            length = RECORD_HEAD.unpack_from(view, offset)[0]
+            stop = start + NONCE_SIZE + length
+            if stop > end:
+                raise InvalidToken
+            data = self.decryptChunk(prefix, index, view[start:stop],
+                                     stop == end)
+            yield offset, decompress(codec, data, zdict)
+            offset = stop
+            index += 1
+        if index == 0:
+            raise InvalidToken
+
+    def readText(self, data):
+        # returns the text of a paper held in any buffer, e.g. a mapped
+        # file, the (offset, digest) of its chunks, which is None for the
+        # single shot formats, and the keyed hash of the text
+        mac = hmac.new(self.mac_key, digestmod=hashlib.sha256)
+        view = memoryview(data)
+        layout = self.parsePrefix(view)
+        if layout is None:
+            data = self.decrypt(view)
+            mac.update(data)
+            return data.decode(), None, mac.digest()
+
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        parts = []
+        chunks = []
+        for offset, data in self.readChunks(view, *layout):
+            chunks.append((offset, chunkDigest(data)))
+            mac.update(data)
+            parts.append(decoder.decode(data))
+        parts.append(decoder.decode(b'', True))
+        return ''.join(parts), chunks, mac.digest()
+
+    def writeText(self, f, text, chunks=None):
+        # writes text as records to f, when chunks describes the current
+        # contents of f leading chunks that did not change are kept in
+        # place. returns the new chunks and whether anything was written
+        writing = chunks is None
+        if writing:
+            prefix = PREFIX + CODEC_HEAD.pack(self.codec, self.dictionary) + \
+                os.urandom(FILE_ID_SIZE)
+            codec = self.codec
+            zdict = self.dictionaries.get(self.dictionary)
+            f.write(prefix)
+            offset = len(prefix)
+        else:
+            # keep the codec and file id the file was written with
+            layout = self.readPrefix(f)
+            if layout is None:
+                raise InvalidToken
+            prefix, codec, zdict = layout
+
+        new_chunks = []
+        for index, (data, last) in enumerate(textChunks(text)):
+            digest = chunkDigest(data)
+            if not writing:
+                if index < len(chunks) and chunks[index][1] == digest and \
+                        last == (index == len(chunks) - 1):
+                    new_chunks.append(chunks[index])
+                    continue
+                writing = True
+                offset = chunks[index][0]
+                f.seek(offset)
+
+            data = compress(codec, data, zdict)
+            record = self.encryptChunk(prefix, index, data, last)
+            f.write(record)
+            new_chunks.append((offset, digest))
+            offset += len(record)
+
+        if writing:
+            f.truncate()
+        return new_chunks, writing
@@ -0,0 +1,115 @@
+import os
+import time
+import argparse
+
+# runs without a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtGui import QTextCursor
+from PyQt5.QtWidgets import QApplication
+
+from paper_editor import PaperEditor
+
+SAMPLE = [
+    '# Heading with **bold** text',
+    'A paragraph line with *italic*, ~~strike~~ and http://example.com/page',
+    'Setext title',
+    '============',
+    '> a quoted line with **bold**',
+    'lazy quote continuation',
+    '',
+    '```',
+    'code **not bold** here',
+    '```',
+    '- list item',
+    '',
+]
+
+
+def makeDocument(lines):
+    return '\n'.join(SAMPLE[i % len(SAMPLE)] for i in range(lines))
+
+
+class Counter:
+    # counts the blocks the highlighter formats
+
+    def __init__(self, highlighter):
+        self.count = 0
+        self.formatBlock = highlighter.formatBlock
+        highlighter.formatBlock = self
+
+    def __call__(self, block, previous):
+        self.count += 1
+        return self.formatBlock(block, previous)
+
+
+def measure(label, app, editor, counter, edit):
+    # the edit itself, then the slices left running on the event loop
+    app.processEvents()
+    counter.count = 0
+    start = time.perf_counter()
+    edit(editor.textCursor())
+    elapsed = time.perf_counter() - start
+    print("%-24s %8.1f ms %8d blocks" % (label, elapsed * 1000,
+                                         counter.count))
+    if not editor.highlighter.isPending():
+        return
+    slices = 0
+    while editor.highlighter.isPending():
+        app.processEvents()
+        slices += 1
+    elapsed = time.perf_counter() - start
+    print("%-24s %8.1f ms %8d blocks %5d slices" % (
+        "  all highlighted", elapsed * 1000, counter.count, slices))
+
+
+def moveTo(cursor, line):
+    block = cursor.document().findBlockByNumber(line)
+    cursor.setPosition(block.position() + block.length() - 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Highlighter benchmark")
+    parser.add_argument('--lines', type=int, default=50000,
+                        help="lines in the generated document")
+    args = parser.parse_args()
+
+    app = QApplication([])
+    editor = PaperEditor()
+    editor.resize(800, 600)
+    editor.show()
+    counter = Counter(editor.highlighter)
+    text = makeDocument(args.lines)
+    middle = args.lines // 2
+
+    measure("load", app, editor, counter, lambda c: editor.setText(text))
+
+    def typeChar(c):
+        moveTo(c, middle + 1)
+        c.insertText('x')
+    measure("edit one line", app, editor, counter, typeChar)
+
+    def openFence(c):
+        moveTo(c, middle)
+        c.insertText('\n~~~')
+    measure("open fence", app, editor, counter, openFence)
+
+    def closeFence(c):
+        moveTo(c, middle + 1)
+        c.movePosition(QTextCursor.StartOfBlock, QTextCursor.KeepAnchor)
+        c.removeSelectedText()
+    measure("close fence", app, editor, counter, closeFence)
+
+    def underline(c):
+        moveTo(c, middle + 2)
+        c.insertText('\n---')
+    measure("setext underline", app, editor, counter, underline)
+
+    highlighter = editor.highlighter
+    measure("rehighlight", app, editor, counter,
+            lambda c: highlighter.rehighlightDeferred())
+    print("cache %d hits %d misses" % (highlighter.hits, highlighter.misses))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,363 +1,574 @@
-import sys
-import os
-
-from PyQt5.QtWidgets import *
-from PyQt5.QtCore import Qt, QEvent
-from PyQt5.QtGui import QIcon, QKeySequence, QColor, QFont, QPixmap
-
-from papers import PapersStore
-from config import PaperConfig
-from paper_editor import PaperEditor
-from password_dlg import PasswordDialog
-
-import qdarkstyle
-
-
-class PaperWindow(QMainWindow):
-
-    def __init__(self):
-        super().__init__()
-
-        self.config = PaperConfig()
-        self.papers = PapersStore(self.config['Paper']['PapersPath'])
-        self.locked = True
-
-        self.initUI()
-
-        self.toggleLock()
-
-    def initUI(self):
-        self.main_widget = QWidget()
-        self.screen_stack = QStackedWidget(self)
-
-        self.resize(self.config['Paper'].getint('Width'),
-                    self.config['Paper'].getint('Height'))
-        self.move(self.config['Paper'].getint('WindowX'),
-                  self.config['Paper'].getint('WindowY'))
-
-        self.setWindowTitle('Paper')
-        self.setWindowIcon(QIcon('icons/paper.png'))
-
-        # hack to set correct icon in windows taskbar
-        if os.name == 'nt':
-            import ctypes
-            myappid = 'msaadat.paper'
-            ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
-
-
-
-        self.tab_bar = QTabWidget(self.screen_stack)
-        self.tab_bar.setTabsClosable(True)
-        self.tab_bar.tabCloseRequested.connect(self.delete_paper)
-        self.tab_bar.tabBarDoubleClicked.connect(self.rename_paper)
-
-        self.hboxContainer = QWidget(self)
-        self.hboxCorner = QHBoxLayout(self.hboxContainer)
-
-        self.tabButton = QToolButton(self.hboxContainer)
-        self.tabButton.setText('➕')
-        font = self.tabButton.font()
-        font.setPointSize(font.pointSize() + 1)
-        self.tabButton.setFont(font)
-        self.tabButton.setAutoRaise(True)
-        self.tabButton.clicked.connect(self.add_paper_handler)
-
-        self.menuBtn = QToolButton(self.hboxContainer)
-        self.menuBtn.setText('☰')
-        self.menuBtn.setAutoRaise(True)
-        font = self.menuBtn.font()
-        font.setPointSize(font.pointSize() + 3)
-        font.setBold(True)
-        self.menuBtn.setFont(font)
-
-        self.lock_action = QAction("Lock", self)
-        # self.lock_action.setShortcuts(QKeySequence("Ctrl+L"))
-        self.lock_action.triggered.connect(self.toggleLock)
-
-        font_action = QAction("Font...", self)
-        font_action.triggered.connect(self.getFont)
-
-        self.menuBtnmenu = QMenu(self.menuBtn)
-        self.menuBtnmenu.installEventFilter(self)
-
-        self.menuBtnmenu.addAction(self.lock_action)
-        self.menuBtnmenu.addAction(font_action)
-        self.menuBtn.setMenu(self.menuBtnmenu)
-        self.menuBtn.setPopupMode(QToolButton.InstantPopup)
-
-        self.hboxCorner.addWidget(self.tabButton)
-        self.hboxCorner.addWidget(self.menuBtn)
-        self.hboxCorner.setContentsMargins(0, 0, 0, 0)
-        self.hboxContainer.setLayout(self.hboxCorner)
-
-        self.tab_bar.setCornerWidget(self.hboxContainer)
-
-        self.unlock_pixmap = QPixmap()
-        self.unlock_pixmap.load("icons/unlock.png")
-        self.lock_screen = QLabel(self.screen_stack)
-        self.lock_screen.setPixmap(self.unlock_pixmap)
-        self.lock_screen.setAlignment(Qt.AlignCenter)
-        self.lock_screen.installEventFilter(self)
-
-        self.screen_stack.insertWidget(0, self.lock_screen)
-        self.screen_stack.insertWidget(1, self.tab_bar)
-
-        self.setCentralWidget(self.screen_stack)
-        self.setStyleSheet("""
-                QTabBar::tab {
-                    padding:3px;
-                }
-
-                QToolButton::menu-indicator { image: none; }
-                """)
-
-        # main window shortcuts
-        lock_shortcut = QShortcut(QKeySequence("Ctrl+L"), self)
-        lock_shortcut.activated.connect(self.toggleLock)
-
-        quit_shortcut = QShortcut(QKeySequence("Ctrl+Q"), self)
-        quit_shortcut.activated.connect(self.close)
-
-        # editor shortcuts
-        save_shortcut = QShortcut(QKeySequence("Ctrl+S"), self.tab_bar)
-        save_shortcut.activated.connect(self.save_paper)
-
-        new_shortcut = QShortcut(QKeySequence("Ctrl+N"), self.tab_bar)
-        new_shortcut.activated.connect(self.add_paper_handler)
-
-        delete_shortcut = QShortcut(QKeySequence("Ctrl+W"), self.tab_bar)
-        delete_shortcut.activated.connect(self.delete_paper_active)
-
-        eval_shortcut = QShortcut(QKeySequence("Ctrl+E"), self.tab_bar)
-        eval_shortcut.activated.connect(self.evalText)
-
-        self.show()
-
-    def toggleLock(self):
-        if self.locked:
-            if self.getPassword():
-                self.loadPapers()
-                self.screen_stack.setCurrentWidget(self.tab_bar)
-                self.locked = False
-        else:
-            if self.closeEditors():
-                self.screen_stack.setCurrentWidget(self.lock_screen)
-                self.locked = True
-
-    def getFont(self, event):
-        prevfont = QFont()
-        if "Font" in self.config['Paper']:
-            prevfont.fromString(self.config['Paper']['Font'])
-
-        font, ok = QFontDialog.getFont(prevfont, self)
-        if ok:
-            self.setFont(font)
-
-    def setFont(self, font=None):
-        if font is None:
-            if "Font" in self.config['Paper']:
-                font = QFont()
-                font.fromString(self.config['Paper']['Font'])
-
-        if font is not None:
-            self.config['Paper']['Font'] = font.toString()
-            for i in range(self.tab_bar.count()):
-                editor = self.tab_bar.widget(i)
-                editor.setFont(font)
-
-    def eventFilter(self, obj, event):
-        if event.type() == QEvent.Show and obj == self.menuBtnmenu:
-            # show menu to the right instead of left
-            pos = obj.pos()
-            geo = self.menuBtn.geometry()
-            obj.move(pos.x() + geo.width() - obj.geometry().width(), pos.y())
-            return True
-        elif event.type() == QEvent.MouseButtonPress and obj == self.lock_screen:
-            self.toggleLock()
-        return False
-
-    def loadPapers(self):
-        try:
-            self.papers.loadPapers()
-        except ValueError as e:
-            QMessageBox.warning(self, "Error",
-                                e.args[0])
-            return
-
-        if not self.papers:
-            self.papers.addPaper("note")
-            self.papers["note"].text = "##My note"
-
-        for i in self.papers:
-            self.add_paper(self.papers[i].name)
-
-        # activate last used paper
-        if "LastPaper" in self.config['Paper']:
-            last_paper = self.config['Paper']['LastPaper']
-            for i in range(0, self.tab_bar.count()):
-                if self.tab_bar.tabText(i) == last_paper:
-                    self.tab_bar.setCurrentIndex(i)
-                    break
-
-        current = self.tab_bar.currentWidget()
-        current.setFocus()
-
-        if "LastCursorPos" in self.config['Paper']:
-            last_pos = self.config['Paper'].getint('LastCursorPos')
-            cursor = self.tab_bar.currentWidget().textCursor()
-            cursor.setPosition(last_pos)
-            self.tab_bar.currentWidget().setTextCursor(cursor)
-
-        self.setFont()
-
-    def getPassword(self):
-        if not self.papers.pw_check_path.exists():
-            pwd, response = PasswordDialog.getPassword(self)
-            if response == QDialog.Accepted and pwd != '':
-                self.papers.changePassword(pwd)
-                return True
-            else:
-                return False
-        else:
-            pwd, response = QInputDialog.getText(self, "Password",
-                                              "Input pasword:",
-                                                      QLineEdit.Password, "")
-            if response == QDialog.Accepted and pwd != '':
-                if self.papers.setPassword(pwd):
-                    return True
-                else:
-                    QMessageBox.warning(self, "Error", "Invalid Password")
-                    return False
-            else:
-                return False
-
-    def evalText(self):
-        editor = self.tab_bar.currentWidget()
-        cursor = editor.textCursor()
-        result = None
-        if cursor.hasSelection():
-            text = cursor.selectedText()
-            try:
-                result = eval(text)
-            except:
-                pass
-            if result is not None:
-                cursor.removeSelectedText()
-                cursor.insertText(str(result))
-        editor.setTextCursor(cursor)
-
-    def closeEditors(self):
-        # check for unsaved papers
-        unsaved = []
-        for i in range(self.tab_bar.count()):
-            editor = self.tab_bar.widget(i)
-            name = self.tab_bar.tabText(i)
-            if editor.dirty:
-                unsaved.append((name, editor))
-
-        if unsaved:
-            reply = QMessageBox.question(self, "Unsaved Papers",
-                                         "Papers contain unsaved changes. Save all before closing?",
-                                         QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel,
-                                         QMessageBox.Cancel)
-            if reply == QMessageBox.Yes:
-                for i, j in unsaved:
-                    self.papers[i].text = j.toPlainText()
-                    self.papers.savePaper(i)
-            if reply == QMessageBox.Cancel:
-                return False
-
-        # save last paper & cursor pos
-        widget = self.tab_bar.currentWidget()
-        if widget is not None:
-            pos = self.tab_bar.currentWidget().textCursor().position()
-            self.config['Paper']['LastCursorPos'] = str(pos)
-            self.config['Paper']['LastPaper'] = self.tab_bar.tabText(self.tab_bar.currentIndex())
-
-        # save position
-        self.config['Paper']['Width'] = str(self.width())
-        self.config['Paper']['Height'] = str(self.height())
-        self.config['Paper']['WindowX'] = str(self.pos().x())
-        self.config['Paper']['WindowY'] = str(self.pos().y())
-
-        self.config.SaveConfig()
-
-        # reset papers and remove all tabs
-        self.papers = PapersStore(self.config['Paper']['PapersPath'])
-        for i in range(self.tab_bar.count()):
-            self.tab_bar.removeTab(0)
-
-        return True
-
-    def closeEvent(self, event):
-        if self.closeEditors():
-            event.accept()
-            sys.exit()
-
-    def add_paper_handler(self):
-        name, okPressed = QInputDialog.getText(self, "New Paper",
-                                               "Paper name:", QLineEdit.Normal,
-                                               "")
-        if okPressed and name != '':
-            if self.papers.addPaper(name):
-                self.add_paper(name)
-            else:
-                QMessageBox.information(self, name, "Paper already exists.")
-
-    def add_paper(self, name):
-        editor = PaperEditor()
-        editor.setText(self.papers[name].text)
-        index = self.tab_bar.addTab(editor, name)
-        self.tab_bar.setCurrentIndex(index)
-        editor.textChanged.connect(self.set_dirty)
-
-    def delete_paper_active(self):
-        index = self.tab_bar.currentIndex()
-        self.delete_paper(index)
-
-    def delete_paper(self, index):
-        name = self.tab_bar.tabText(index)
-        reply = QMessageBox.question(self, "Delete Paper",
-                                     "Are you sure to delete paper " + name,
-                                     QMessageBox.Yes | QMessageBox.No,
-                                     QMessageBox.No)
-        if reply == QMessageBox.Yes:
-            self.papers.deletePaper(name)
-            self.tab_bar.removeTab(index)
-
-    def save_paper(self):
-        textbox = self.tab_bar.currentWidget()
-        index = self.tab_bar.currentIndex()
-        name = self.tab_bar.tabText(index)
-        self.papers[name].text = textbox.toPlainText()
-        self.papers.savePaper(name)
-        textbox.setDirty(False)
-        self.set_dirty(False)
-
-    def set_dirty(self, status=True):
-        textbox = self.tab_bar.currentWidget()
-        textbox.setDirty(status)
-        index = self.tab_bar.currentIndex()
-        if status:
-            self.tab_bar.tabBar().setTabTextColor(index, QColor("#aaaaaa"))
-        else:
-            self.tab_bar.tabBar().setTabTextColor(index, QColor())
-
-    def rename_paper(self, index):
-        name = self.tab_bar.tabText(index)
-        rename, okPressed = QInputDialog.getText(self, "Rename Paper",
-                                                 "Paper name:",
-                                                 QLineEdit.Normal, "")
-        if okPressed and rename != '':
-            if self.papers.renamePaper(name, rename):
-                self.tab_bar.setTabText(index, rename)
-            else:
-                QMessageBox.information(self, rename, "Paper already exists.")
-
-
-if __name__ == '__main__':
-
-    app = QApplication(sys.argv)
-    app.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
-    p = PaperWindow()
-    sys.exit(app.exec_())
+import sys
+import os
+import time
+
+from PyQt5.QtWidgets import *
+from PyQt5.QtCore import Qt, QEvent, QTimer
+from PyQt5.QtGui import QIcon, QKeySequence, QColor, QFont, QPixmap
+
+from papers import PapersStore, calibrateKdf
+from config import PaperConfig
+from paper_editor import PaperEditor
+from password_dlg import PasswordDialog
+from save_worker import SaveWorker
+from store_watcher import StoreWatcher
+
+import qdarkstyle
+
+
+class PaperWindow(QMainWindow):
+
+    def __init__(self):
+        super().__init__()
+
+        self.config = PaperConfig()
+        self.papers = self.open_store()
+        self.locked = True
+
+        self.saver = SaveWorker(self)
+        self.saver.saved.connect(self.paper_saved)
+        # errors of failed saves, shown together once the batch is done
+        self.save_errors = []
+
+        # autosave runs once typing has been idle for AutoSaveIdle ms
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.setSingleShot(True)
+        self.autosave_timer.timeout.connect(self.autosave)
+        self.autosave_times = {}
+
+        # reloads papers changed by other programs
+        self.watcher = StoreWatcher(self,
+                                    self.config['Paper'].getint('WatchDelay'))
+        self.watcher.changed.connect(self.store_changed)
+
+        self.initUI()
+
+        self.toggleLock()
+
+    def initUI(self):
+        self.main_widget = QWidget()
+        self.screen_stack = QStackedWidget(self)
+
+        self.resize(self.config['Paper'].getint('Width'),
+                    self.config['Paper'].getint('Height'))
+        self.move(self.config['Paper'].getint('WindowX'),
+                  self.config['Paper'].getint('WindowY'))
+
+        self.setWindowTitle('Paper')
+        self.setWindowIcon(QIcon('icons/paper.png'))
+
+        # hack to set correct icon in windows taskbar
+        if os.name == 'nt':
+            import ctypes
+            myappid = 'msaadat.paper'
+            ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
+
+
+
+        self.tab_bar = QTabWidget(self.screen_stack)
+        self.tab_bar.setTabsClosable(True)
+        self.tab_bar.setMovable(True)
+        self.tab_bar.tabBar().tabMoved.connect(self.paper_moved)
+        self.tab_bar.tabCloseRequested.connect(self.delete_paper)
+        self.tab_bar.tabBarDoubleClicked.connect(self.rename_paper)
+        self.tab_bar.currentChanged.connect(self.load_paper)
+
+        self.hboxContainer = QWidget(self)
+        self.hboxCorner = QHBoxLayout(self.hboxContainer)
+
+        self.tabButton = QToolButton(self.hboxContainer)
+        self.tabButton.setText('➕')
+        font = self.tabButton.font()
+        font.setPointSize(font.pointSize() + 1)
+        self.tabButton.setFont(font)
+        self.tabButton.setAutoRaise(True)
+        self.tabButton.clicked.connect(self.add_paper_handler)
+
+        self.menuBtn = QToolButton(self.hboxContainer)
+        self.menuBtn.setText('☰')
+        self.menuBtn.setAutoRaise(True)
+        font = self.menuBtn.font()
+        font.setPointSize(font.pointSize() + 3)
+        font.setBold(True)
+        self.menuBtn.setFont(font)
+
+        self.lock_action = QAction("Lock", self)
+        # self.lock_action.setShortcuts(QKeySequence("Ctrl+L"))
+        self.lock_action.triggered.connect(self.toggleLock)
+
+        font_action = QAction("Font...", self)
+        font_action.triggered.connect(self.getFont)
+
+        self.menuBtnmenu = QMenu(self.menuBtn)
+        self.menuBtnmenu.installEventFilter(self)
+
+        self.menuBtnmenu.addAction(self.lock_action)
+        self.menuBtnmenu.addAction(font_action)
+        self.menuBtn.setMenu(self.menuBtnmenu)
+        self.menuBtn.setPopupMode(QToolButton.InstantPopup)
+
+        self.hboxCorner.addWidget(self.tabButton)
+        self.hboxCorner.addWidget(self.menuBtn)
+        self.hboxCorner.setContentsMargins(0, 0, 0, 0)
+        self.hboxContainer.setLayout(self.hboxCorner)
+
+        self.tab_bar.setCornerWidget(self.hboxContainer)
+
+        self.unlock_pixmap = QPixmap()
+        self.unlock_pixmap.load("icons/unlock.png")
+        self.lock_screen = QLabel(self.screen_stack)
+        self.lock_screen.setPixmap(self.unlock_pixmap)
+        self.lock_screen.setAlignment(Qt.AlignCenter)
+        self.lock_screen.installEventFilter(self)
+
+        self.screen_stack.insertWidget(0, self.lock_screen)
+        self.screen_stack.insertWidget(1, self.tab_bar)
+
+        self.setCentralWidget(self.screen_stack)
+        self.setStyleSheet("""
+                QTabBar::tab {
+                    padding:3px;
+                }
+
+                QToolButton::menu-indicator { image: none; }
+                """)
+
+        # main window shortcuts
+        lock_shortcut = QShortcut(QKeySequence("Ctrl+L"), self)
+        lock_shortcut.activated.connect(self.toggleLock)
+
+        quit_shortcut = QShortcut(QKeySequence("Ctrl+Q"), self)
+        quit_shortcut.activated.connect(self.close)
+
+        # editor shortcuts
+        save_shortcut = QShortcut(QKeySequence("Ctrl+S"), self.tab_bar)
+        save_shortcut.activated.connect(self.save_paper)
+
+        new_shortcut = QShortcut(QKeySequence("Ctrl+N"), self.tab_bar)
+        new_shortcut.activated.connect(self.add_paper_handler)
+
+        delete_shortcut = QShortcut(QKeySequence("Ctrl+W"), self.tab_bar)
+        delete_shortcut.activated.connect(self.delete_paper_active)
+
+        eval_shortcut = QShortcut(QKeySequence("Ctrl+E"), self.tab_bar)
+        eval_shortcut.activated.connect(self.evalText)
+
+        self.show()
+
+    def open_store(self):
+        return PapersStore(self.config['Paper']['PapersPath'],
+                           self.config['Paper']['Compression'],
+                           self.config['Paper']['Storage'],
+                           self.config['Paper']['Kdf'],
+                           self.config['Paper'].getint('KdfTime') / 1000)
+
+    def toggleLock(self):
+        if self.locked:
+            if self.getPassword():
+                self.loadPapers()
+                self.screen_stack.setCurrentWidget(self.tab_bar)
+                self.locked = False
+        else:
+            if self.closeEditors():
+                self.screen_stack.setCurrentWidget(self.lock_screen)
+                self.locked = True
+
+    def getFont(self, event):
+        prevfont = QFont()
+        if "Font" in self.config['Paper']:
+            prevfont.fromString(self.config['Paper']['Font'])
+
+        font, ok = QFontDialog.getFont(prevfont, self)
+        if ok:
+            self.setFont(font)
+
+    def paperFont(self):
+        if "Font" in self.config['Paper']:
+            font = QFont()
+            font.fromString(self.config['Paper']['Font'])
+            return font
+        return None
+
+    def setFont(self, font=None):
+        if font is None:
+            font = self.paperFont()
+
+        if font is not None:
+            self.config['Paper']['Font'] = font.toString()
+            for i in range(self.tab_bar.count()):
+                editor = self.tab_bar.widget(i)
+                editor.setFont(font)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Show and obj == self.menuBtnmenu:
+            # show menu to the right instead of left
+            pos = obj.pos()
+            geo = self.menuBtn.geometry()
+            obj.move(pos.x() + geo.width() - obj.geometry().width(), pos.y())
+            return True
+        elif event.type() == QEvent.MouseButtonPress and obj == self.lock_screen:
+            self.toggleLock()
+        return False
+
+    def loadPapers(self):
+        try:
+            self.papers.loadPapers()
+        except ValueError as e:
+            QMessageBox.warning(self, "Error",
+                                e.args[0])
+            return
+
+        if not self.papers:
+            self.papers.addPaper("note")
+            self.papers["note"].text = "##My note"
+
+        # papers are decrypted when their tab is first shown
+        self.tab_bar.blockSignals(True)
+        for i in self.papers:
+            self.add_paper(self.papers[i].name, False)
+        self.tab_bar.blockSignals(False)
+
+        # activate last used paper
+        if "LastPaper" in self.config['Paper']:
+            last_paper = self.config['Paper']['LastPaper']
+            for i in range(0, self.tab_bar.count()):
+                if self.tab_bar.tabText(i) == last_paper:
+                    self.tab_bar.setCurrentIndex(i)
+                    break
+
+        self.load_paper(self.tab_bar.currentIndex())
+        current = self.tab_bar.currentWidget()
+        current.setFocus()
+
+        if "LastCursorPos" in self.config['Paper']:
+            last_pos = self.config['Paper'].getint('LastCursorPos')
+            cursor = self.tab_bar.currentWidget().textCursor()
+            cursor.setPosition(last_pos)
+            self.tab_bar.currentWidget().setTextCursor(cursor)
+
+        self.setFont()
+        self.watch_store()
+
+    def getPassword(self):
+        if not self.papers.hasPassword():
+            pwd, response = PasswordDialog.getPassword(self)
+            if response == QDialog.Accepted and pwd != '':
+                kdf = calibrateKdf(self.config['Paper']['Kdf'],
+                                   self.config['Paper'].getint('KdfTime') / 1000)
+                self.papers.changePassword(pwd, kdf)
+                return True
+            else:
+                return False
+        else:
+            pwd, response = QInputDialog.getText(self, "Password",
+                                              "Input pasword:",
+                                                      QLineEdit.Password, "")
+            if response == QDialog.Accepted and pwd != '':
+                if self.papers.setPassword(pwd):
+                    return True
+                else:
+                    QMessageBox.warning(self, "Error", "Invalid Password")
+                    return False
+            else:
+                return False
+
+    def evalText(self):
+        editor = self.tab_bar.currentWidget()
+        cursor = editor.textCursor()
+        result = None
+        if cursor.hasSelection():
+            text = cursor.selectedText()
+            try:
+                result = eval(text)
+            except:
+                pass
+            if result is not None:
+                cursor.removeSelectedText()
+                cursor.insertText(str(result))
+        editor.setTextCursor(cursor)
+
+    def closeEditors(self):
+        self.autosave_timer.stop()
+        self.autosave_times.clear()
+        self.flush_saves()
+
+        # check for unsaved papers
+        unsaved = []
+        for i in range(self.tab_bar.count()):
+            editor = self.tab_bar.widget(i)
+            name = self.tab_bar.tabText(i)
+            if editor.dirty:
+                unsaved.append((name, editor))
+
+        if unsaved:
+            reply = QMessageBox.question(self, "Unsaved Papers",
+                                         "Papers contain unsaved changes. Save all before closing?",
+                                         QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel,
+                                         QMessageBox.Cancel)
+            if reply == QMessageBox.Yes:
+                self.saver.saveBatch(self.papers,
+                                     [(i, j.toPlainText(), j.document().revision())
+                                      for i, j in unsaved])
+                self.flush_saves()
+                # a failed save was reported, keep the papers open
+                if any(j.dirty for i, j in unsaved):
+                    return False
+            if reply == QMessageBox.Cancel:
+                return False
+
+        self.watcher.stop()
+
+        # save last paper & cursor pos
+        widget = self.tab_bar.currentWidget()
+        if widget is not None:
+            pos = self.tab_bar.currentWidget().textCursor().position()
+            self.config['Paper']['LastCursorPos'] = str(pos)
+            self.config['Paper']['LastPaper'] = self.tab_bar.tabText(self.tab_bar.currentIndex())
+
+        # save position
+        self.config['Paper']['Width'] = str(self.width())
+        self.config['Paper']['Height'] = str(self.height())
+        self.config['Paper']['WindowX'] = str(self.pos().x())
+        self.config['Paper']['WindowY'] = str(self.pos().y())
+
+        self.config.SaveConfig()
+
+        # forget the papers and remove all tabs
+        self.papers.closePapers()
+        self.tab_bar.blockSignals(True)
+        for i in range(self.tab_bar.count()):
+            self.tab_bar.removeTab(0)
+        self.tab_bar.blockSignals(False)
+
+        return True
+
+    def closeEvent(self, event):
+        if self.closeEditors():
+            event.accept()
+            sys.exit()
+
+    def add_paper_handler(self):
+        name, okPressed = QInputDialog.getText(self, "New Paper",
+                                               "Paper name:", QLineEdit.Normal,
+                                               "")
+        if okPressed and name != '':
+            if self.papers.addPaper(name):
+                self.add_paper(name)
+            else:
+                QMessageBox.information(self, name, "Paper already exists.")
+
+    def add_paper(self, name, activate=True):
+        editor = PaperEditor()
+        font = self.paperFont()
+        if font is not None:
+            editor.setFont(font)
+        index = self.tab_bar.addTab(editor, name)
+        if activate:
+            self.tab_bar.setCurrentIndex(index)
+            self.load_paper(index)
+
+    def load_paper(self, index):
+        editor = self.tab_bar.widget(index)
+        if editor is None or editor.loaded:
+            return
+
+        name = self.tab_bar.tabText(index)
+        try:
+            text = self.papers[name].text
+        except ValueError as e:
+            QMessageBox.warning(self, "Error", e.args[0])
+            return
+        except (FileNotFoundError, KeyError):
+            # deleted by another program, the reload drops its tab
+            QMessageBox.warning(self, "Error", "Paper " + name +
+                                " was deleted by another program")
+            QTimer.singleShot(0, self.store_changed)
+            return
+        except OSError as e:
+            QMessageBox.warning(self, "Error", str(e))
+            return
+
+        editor.setText(text)
+        editor.loaded = True
+        editor.textChanged.connect(self.set_dirty)
+        self.watch_store()
+
+    def find_tab(self, name):
+        for i in range(self.tab_bar.count()):
+            if self.tab_bar.tabText(i) == name:
+                return i
+        return -1
+
+    def watch_store(self):
+        self.watcher.watch(self.papers.watchPaths())
+
+    def store_changed(self):
+        # applies what other programs changed in the store, dirty papers
+        # are only replaced if the user agrees
+        if self.locked:
+            return
+        self.flush_saves()
+        try:
+            added, removed, renamed, changed = self.papers.reloadPapers()
+        except (OSError, ValueError):
+            # caught mid-write, the rest of the write triggers a reload
+            self.watch_store()
+            return
+
+        for paper in removed:
+            index = self.find_tab(paper.name)
+            if self.tab_bar.widget(index).dirty:
+                reply = QMessageBox.question(self, "Paper Deleted",
+                                             "Paper " + paper.name + " was deleted by another program. Keep your copy?",
+                                             QMessageBox.Yes | QMessageBox.No,
+                                             QMessageBox.Yes)
+                if reply == QMessageBox.Yes and \
+                        self.papers.restorePaper(paper):
+                    continue
+            self.tab_bar.removeTab(index)
+
+        tabs = [(self.find_tab(i), j) for i, j in renamed]
+        for index, rename in tabs:
+            self.tab_bar.setTabText(index, rename)
+
+        for name in added:
+            self.add_paper(name, False)
+
+        for name in changed:
+            index = self.find_tab(name)
+            editor = self.tab_bar.widget(index)
+            if not editor.loaded:
+                continue
+            if editor.dirty:
+                reply = QMessageBox.question(self, "Paper Changed",
+                                             "Paper " + name + " was changed by another program. Reload it and discard your changes?",
+                                             QMessageBox.Yes | QMessageBox.No,
+                                             QMessageBox.No)
+                if reply != QMessageBox.Yes:
+                    continue
+            self.reload_editor(index)
+
+        self.watch_store()
+
+    def reload_editor(self, index):
+        editor = self.tab_bar.widget(index)
+        name = self.tab_bar.tabText(index)
+        pos = editor.textCursor().position()
+        editor.blockSignals(True)
+        editor.setText(self.papers[name].text)
+        editor.blockSignals(False)
+        cursor = editor.textCursor()
+        cursor.setPosition(min(pos, len(editor.toPlainText())))
+        editor.setTextCursor(cursor)
+        self.set_dirty(False, index)
+
+    def delete_paper_active(self):
+        index = self.tab_bar.currentIndex()
+        self.delete_paper(index)
+
+    def delete_paper(self, index):
+        name = self.tab_bar.tabText(index)
+        reply = QMessageBox.question(self, "Delete Paper",
+                                     "Are you sure to delete paper " + name,
+                                     QMessageBox.Yes | QMessageBox.No,
+                                     QMessageBox.No)
+        if reply == QMessageBox.Yes:
+            self.saver.wait()
+            self.papers.deletePaper(name)
+            self.tab_bar.removeTab(index)
+
+    def paper_moved(self, source, dest):
+        names = [self.tab_bar.tabText(i) for i in range(self.tab_bar.count())]
+        self.papers.reorderPapers(names)
+
+    def save_paper(self):
+        textbox = self.tab_bar.currentWidget()
+        index = self.tab_bar.currentIndex()
+        name = self.tab_bar.tabText(index)
+        # encrypting and writing happens on the save worker
+        self.saver.save(self.papers, name, textbox.toPlainText(),
+                        textbox.document().revision())
+
+    def paper_saved(self, name, revision, error):
+        if error:
+            if not self.save_errors:
+                QTimer.singleShot(0, self.show_save_errors)
+            if error not in self.save_errors:
+                self.save_errors.append(error)
+            return
+
+        for i in range(self.tab_bar.count()):
+            if self.tab_bar.tabText(i) == name:
+                # keep the paper dirty if it was edited since the snapshot
+                if self.tab_bar.widget(i).document().revision() == revision:
+                    self.set_dirty(False, i)
+                break
+
+    def show_save_errors(self):
+        errors = self.save_errors
+        self.save_errors = []
+        QMessageBox.warning(self, "Error", "\n".join(errors))
+
+    def autosave(self):
+        # saves every dirty paper in one batch, papers autosaved less than
+        # AutoSaveInterval ms ago are retried once the interval has passed
+        interval = self.config['Paper'].getint('AutoSaveInterval') / 1000
+        now = time.monotonic()
+        retry = None
+        batch = []
+        for i in range(self.tab_bar.count()):
+            editor = self.tab_bar.widget(i)
+            if not editor.dirty:
+                continue
+            name = self.tab_bar.tabText(i)
+            last = self.autosave_times.get(name)
+            if last is not None and now - last < interval:
+                remaining = interval - (now - last)
+                if retry is None or remaining < retry:
+                    retry = remaining
+                continue
+            batch.append((name, editor.toPlainText(),
+                          editor.document().revision()))
+            self.autosave_times[name] = now
+
+        if batch:
+            self.saver.saveBatch(self.papers, batch)
+        if retry is not None:
+            self.autosave_timer.start(int(retry * 1000))
+
+    def flush_saves(self):
+        # wait for queued saves and deliver their results
+        self.saver.wait()
+        QApplication.sendPostedEvents(None, QEvent.MetaCall)
+
+    def set_dirty(self, status=True, index=None):
+        if index is None:
+            index = self.tab_bar.currentIndex()
+        textbox = self.tab_bar.widget(index)
+        textbox.setDirty(status)
+        if status and self.config['Paper'].getboolean('AutoSave'):
+            self.autosave_timer.start(self.config['Paper'].getint('AutoSaveIdle'))
+        if status:
+            self.tab_bar.tabBar().setTabTextColor(index, QColor("#aaaaaa"))
+        else:
+            self.tab_bar.tabBar().setTabTextColor(index, QColor())
+
+    def rename_paper(self, index):
+        name = self.tab_bar.tabText(index)
+        rename, okPressed = QInputDialog.getText(self, "Rename Paper",
+                                                 "Paper name:",
+                                                 QLineEdit.Normal, "")
+        if okPressed and rename != '':
+            self.saver.wait()
+            if self.papers.renamePaper(name, rename):
+                self.tab_bar.setTabText(index, rename)
+            else:
+                QMessageBox.information(self, rename, "Paper already exists.")
+
+
+if __name__ == '__main__':
+
+    app = QApplication(sys.argv)
+    app.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
+    p = PaperWindow()
+    sys.exit(app.exec_())
@@ -1,8 +1,11 @@
 import re
+import time
 import webbrowser
 
-from PyQt5.QtCore import Qt, QEvent
-from PyQt5.QtGui import QTextCursor, QSyntaxHighlighter, QTextCharFormat, QFont, QBrush
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QEvent, QPoint, QTimer
+from PyQt5.QtGui import QTextCursor, QSyntaxHighlighter, QTextCharFormat, QTextFormat, QTextLayout, QFont, QBrush
 from PyQt5.QtWidgets import QTextEdit
 
 regex = {
@@ -12,47 +15,303 @@ regex = {
 'strike': '\B\~{2}(.+?)\~{2}\B',
 'empty_list':'^\\s*[+\\-\\*]\\s*$',
 'list':'^(\\s*)([+\\-\\*])(\\s?)',
-'url':'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
+'url':'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+',
+'fence':'^ {0,3}(`{3,}|~{3,})',
+'quote':'^ {0,3}>',
+'setext':'^ {0,3}(=+|-{2,})\\s*$'
 }
 
+# inline rules scanned in one pass, tried in this order at each position so
+# ** is bold rather than two italics; the lookahead lets the scanner skip
+# straight to characters a rule can start with
+inlineRules = ('bold', 'italic', 'strike', 'url')
+inlineRegex = re.compile('(?=[*~h])(?:' + '|'.join(
+    '(?P<%s>%s)' % (i, regex[i]) for i in inlineRules) + ')')
+headingRegex = re.compile(regex['heading'])
+fenceRegex = re.compile(regex['fence'])
+quoteRegex = re.compile(regex['quote'])
+setextRegex = re.compile(regex['setext'])
+
+# block states, what the next line continues from
+NORMAL = 0
+# text a setext underline on the next line turns into a heading
+PARAGRAPH = 1
+# text the next line underlines
+SETEXT = 2
+QUOTE = 3
+# inside a code block opened by the fence character
+FENCE_STATES = {'`': 4, '~': 5}
+FENCE_CHARS = {4: '`', 5: '~'}
+# left for a slice to highlight, the lines after it take it as normal
+PENDING = -2
+
+# seconds a pass highlights lines out of view before leaving the rest to
+# slices run from the event loop
+SLICE_TIME = 0.01
+# lines whose formats are kept for when they are highlighted again
+CACHE_SIZE = 8192
+
 class MarkdownHighlighter(QSyntaxHighlighter):
 
     def __init__(self, parent=None):
         super().__init__(parent)
+        # first and last block number in view
+        self.visible = (0, 0)
+        # end of the current pass's time slice
+        self.deadline = None
+        # block number the next slice starts looking for pending blocks
+        self.resume = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.highlightSlice)
+        # (text, state, underlined) -> (state, spans), least recently used
+        # first
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
         self.initRules()
+        # connected after the highlighter's own handler so the edited
+        # blocks are highlighted first
+        parent.contentsChange.connect(self.checkUnderline)
+        parent.contentsChange.connect(self.restartSlices)
 
     def initRules(self):
-        self.highlightingRules = []
+        # sized relative to the document font, so a font change needs no
+        # new formats and no rehighlight
         headingFormat = QTextCharFormat()
-        defaultSize = self.parent().defaultFont().pointSize()
-        headingFormat.setFontPointSize(defaultSize * 1.3)
+        headingFormat.setProperty(QTextFormat.FontSizeAdjustment, 1)
         headingFormat.setFontWeight(QFont.Bold)
-        self.highlightingRules.append((regex['heading'], headingFormat))
 
         italicFormat = QTextCharFormat()
         italicFormat.setFontItalic(True)
-        self.highlightingRules.append((regex['italic'], italicFormat))
 
         boldFormat = QTextCharFormat()
         boldFormat.setFontWeight(QFont.Bold)
-        self.highlightingRules.append((regex['bold'], boldFormat))
 
         strikeFormat = QTextCharFormat()
         strikeFormat.setFontStrikeOut(True)
-        self.highlightingRules.append((regex['strike'], strikeFormat))
 
         urlFormat = QTextCharFormat()
         urlFormat.setFontUnderline(True)
         urlFormat.setForeground(QBrush(Qt.blue))
-        self.highlightingRules.append((regex['url'], urlFormat))
 
-        self.rehighlight()
+        quoteFormat = QTextCharFormat()
+        quoteFormat.setFontItalic(True)
+        quoteFormat.setForeground(QBrush(Qt.darkGray))
+
+        codeFormat = QTextCharFormat()
+        codeFormat.setFontFamily('monospace')
+        codeFormat.setFontFixedPitch(True)
+
+        self.codeFormat = codeFormat
+        self.lineFormats = {'heading': headingFormat, 'quote': quoteFormat}
+        inlineFormats = {'bold': boldFormat, 'italic': italicFormat,
+                         'strike': strikeFormat, 'url': urlFormat}
+        # inline formats inside a heading or quote keep the line's format
+        self.inlineFormats = {None: inlineFormats}
+        for line, lineFormat in self.lineFormats.items():
+            self.inlineFormats[line] = {}
+            for name, frmt in inlineFormats.items():
+                merged = QTextCharFormat(lineFormat)
+                merged.merge(frmt)
+                self.inlineFormats[line][name] = merged
+
+        self.cache.clear()
+        self.rehighlightDeferred()
 
     def highlightBlock(self, text):
-        for pattern, frmt in self.highlightingRules:
-            m = re.search(pattern, text)
-            if m:
-                self.setFormat(m.start(), m.end(), frmt)
+        block = self.currentBlock()
+        number = block.blockNumber()
+        if not self.visible[0] <= number <= self.visible[1] and \
+                not self.inSlice():
+            # the slice starting at the first pending block carries on
+            # while states change, the blocks after it keep their state
+            # so the highlighter stops at the end of the edit
+            if self.previousBlockState() != PENDING:
+                self.setCurrentBlockState(PENDING)
+                self.deferBlock(number)
+            return
+
+        state, spans = self.formatBlock(block, self.previousBlockState())
+        for start, length, frmt in spans:
+            self.setFormat(start, length, frmt)
+        self.setCurrentBlockState(state)
+
+    def formatBlock(self, block, previous):
+        # returns the block's state and (start, length, format) spans,
+        # only blocks whose state changes carry the highlighting on to the
+        # next line so an edit rescans until the states match again
+        text = block.text()
+        # states that do not carry into a line share its entry, the
+        # text itself is part of the key so lines never collide
+        if previous not in FENCE_CHARS and previous not in (QUOTE, SETEXT):
+            previous = NORMAL
+        key = (text, previous, self.isUnderlined(block))
+        result = self.cache.get(key)
+        if result is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = self.scanText(text, previous, key[2])
+        self.cache[key] = result
+        if len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return result
+
+    def scanText(self, text, previous, underlined):
+        if previous in FENCE_CHARS:
+            m = fenceRegex.match(text)
+            if m and m.group(1)[0] == FENCE_CHARS[previous] and \
+                    not text[m.end():].strip():
+                return NORMAL, ((0, len(text), self.codeFormat),)
+            return previous, ((0, len(text), self.codeFormat),)
+
+        m = fenceRegex.match(text)
+        if m:
+            return FENCE_STATES[m.group(1)[0]], ((0, len(text), self.codeFormat),)
+        if not text.strip():
+            return NORMAL, ()
+
+        line = None
+        state = NORMAL
+        if headingRegex.match(text):
+            line = 'heading'
+        elif quoteRegex.match(text) or previous == QUOTE:
+            # lines following a quote belong to it up to a blank line
+            line = 'quote'
+            state = QUOTE
+        elif previous == SETEXT and setextRegex.match(text):
+            line = 'heading'
+        elif underlined:
+            line = 'heading'
+            state = SETEXT
+        else:
+            state = PARAGRAPH
+
+        spans = []
+        lineFormat = self.lineFormats.get(line)
+        formats = self.inlineFormats[line]
+        pos = 0
+        for m in inlineRegex.finditer(text):
+            if lineFormat is not None and m.start() > pos:
+                spans.append((pos, m.start() - pos, lineFormat))
+            spans.append((m.start(), m.end() - m.start(), formats[m.lastgroup]))
+            pos = m.end()
+        if lineFormat is not None and pos < len(text):
+            spans.append((pos, len(text) - pos, lineFormat))
+        return state, tuple(spans)
+
+    def isUnderlined(self, block):
+        following = block.next()
+        return following.isValid() and \
+            setextRegex.match(following.text()) is not None
+
+    def checkUnderline(self, position, removed, added):
+        # an underline changes the line above it, which the highlighter
+        # does not revisit on its own
+        block = self.document().findBlock(position).previous()
+        if block.userState() in (PARAGRAPH, SETEXT) and \
+                (block.userState() == SETEXT) != self.isUnderlined(block):
+            self.rehighlightBlock(block)
+
+    def inSlice(self):
+        # every pass the document triggers gets one time slice, it ends
+        # once control is back in the event loop
+        now = time.perf_counter()
+        if self.deadline is None:
+            self.deadline = now + SLICE_TIME
+            QTimer.singleShot(0, self.endSlice)
+        return now < self.deadline
+
+    def endSlice(self):
+        self.deadline = None
+
+    def deferBlock(self, number):
+        if self.resume is None or number < self.resume:
+            self.resume = number
+            self.timer.start()
+
+    def restartSlices(self, position, removed, added):
+        # slices start over from the edit, block numbers after it moved
+        if self.resume is None:
+            return
+        number = self.document().findBlock(position).blockNumber()
+        self.resume = min(self.resume, number)
+        self.timer.start()
+
+    def highlightBlocks(self, block, last, deadline):
+        # formats blocks straight into their layouts and marks the document
+        # dirty once, each rehighlightBlock call outside of an edit lays
+        # out the rest of the document again; goes on past the last block
+        # while states change and time is left
+        start = None
+        changed = True
+        while block.isValid():
+            if block.blockNumber() > last:
+                if not changed:
+                    break
+                if time.perf_counter() > deadline:
+                    block.setUserState(PENDING)
+                    break
+
+            state, spans = self.formatBlock(block, block.previous().userState())
+            # plain lines that stay plain need no new layout
+            if spans or block.layout().formats():
+                ranges = []
+                for pos, length, frmt in spans:
+                    r = QTextLayout.FormatRange()
+                    r.start = pos
+                    r.length = length
+                    r.format = frmt
+                    ranges.append(r)
+                block.layout().setFormats(ranges)
+                if start is None:
+                    start = block.position()
+                end = block.position() + block.length()
+            changed = state != block.userState()
+            block.setUserState(state)
+            block = block.next()
+
+        if start is not None:
+            self.document().markContentsDirty(start, end - start)
+        return block
+
+    def highlightSlice(self):
+        block = self.document().findBlockByNumber(self.resume)
+        self.resume = None
+        deadline = time.perf_counter() + SLICE_TIME
+        while block.isValid() and time.perf_counter() < deadline:
+            if block.userState() == PENDING:
+                block = self.highlightBlocks(block, -1, deadline)
+            else:
+                block = block.next()
+        if block.isValid():
+            self.deferBlock(block.blockNumber())
+
+    def showBlocks(self, first, last):
+        # blocks scrolled into view are highlighted ahead of the slices
+        self.visible = (first, last)
+        block = self.document().findBlockByNumber(first)
+        while block.isValid() and block.blockNumber() <= last:
+            if block.userState() == PENDING:
+                deadline = time.perf_counter() + SLICE_TIME
+                block = self.highlightBlocks(block, last, deadline)
+            else:
+                block = block.next()
+
+    def rehighlightDeferred(self):
+        # like rehighlight() but only the visible blocks are redone now
+        block = self.document().begin()
+        while block.isValid():
+            block.setUserState(PENDING)
+            block = block.next()
+        self.deferBlock(0)
+        self.showBlocks(*self.visible)
+
+    def isPending(self):
+        return self.resume is not None
 
 
 class PaperEditor(QTextEdit):
@@ -61,18 +320,55 @@ class PaperEditor(QTextEdit):
         super().__init__()
         self.setAcceptRichText(False)
         self.dirty = False
+        self.loaded = False
+        # the layout is only half built while the text is replaced
+        self.settingText = False
         self.highlighter = MarkdownHighlighter(self.document())
         self.tabChar = 4 * ' '
         self.installEventFilter(self)
         self.viewport().installEventFilter(self)
+        self.verticalScrollBar().valueChanged.connect(self.showBlocks)
+        # font set while the tab was hidden, applied when it is shown
+        self.pendingFont = None
+
+    def setText(self, text):
+        # a new text starts at the top, only the lines that fit the view
+        # are highlighted right away
+        lines = self.viewport().height() // self.fontMetrics().lineSpacing()
+        self.highlighter.visible = (0, lines)
+        self.settingText = True
+        super().setText(text)
+        self.settingText = False
+        self.showBlocks()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.showBlocks()
+
+    def showBlocks(self, *args):
+        if self.settingText:
+            return
+        # points in the document margin do not hit a block
+        margin = int(self.document().documentMargin())
+        first = self.cursorForPosition(QPoint(margin, margin))
+        last = self.cursorForPosition(
+            QPoint(margin, self.viewport().height() - margin))
+        self.highlighter.showBlocks(first.blockNumber(), last.blockNumber())
 
     def setFont(self, font):
-        super().setFont(font)
+        # each font change lays out the whole document again, hidden tabs
+        # only do that once they are shown
+        if self.isVisible():
+            self.pendingFont = None
+            super().setFont(font)
+        else:
+            self.pendingFont = font
 
-        # block signals as highlighter somehow sends textChanged signal
-        self.blockSignals(True)
-        self.highlighter.initRules()
-        self.blockSignals(False)
+    def showEvent(self, event):
+        if self.pendingFont is not None:
+            super().setFont(self.pendingFont)
+            self.pendingFont = None
+        super().showEvent(event)
 
     def setDirty(self, status=True):
         self.dirty = status
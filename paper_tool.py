@@ -0,0 +1,218 @@
+import io
+import sys
+import json
+import time
+import getpass
+import argparse
+
+from pathlib import Path
+
+from papers import PapersStore, calibrateKdf
+from storage import (openStorage, copyStorage, StoreLock, DirectoryStorage,
+                     ShardedStorage, PackedStorage, SqliteStorage)
+from container import PaperCipher, trainDictionary, zstandard
+from config import PaperConfig
+
+
+def unlock(args, use_index=True):
+    store = PapersStore(args.path, args.compression, args.storage,
+                        args.kdf, args.target / 1000)
+    if not store.hasPassword():
+        sys.exit("No password set for store " + str(args.path))
+
+    pwd = getpass.getpass("Input password: ")
+    if not store.setPassword(pwd):
+        sys.exit("Invalid Password")
+    store.loadPapers(use_index)
+    return store, pwd
+
+
+def calibrate(args):
+    kdf = calibrateKdf(args.kdf, args.target / 1000)
+    print(json.dumps(kdf))
+
+    if args.apply:
+        store, pwd = unlock(args)
+        store.changePassword(pwd, kdf)
+        print("Store key rewrapped")
+
+
+def migrate(args):
+    store, pwd = unlock(args)
+    count = 0
+    for name in store.upgradePapers():
+        count += 1
+        print(name)
+    print("%d papers converted" % count)
+
+
+def train(args):
+    store, pwd = unlock(args)
+    if store.trainDictionary() is None:
+        print("No dictionary trained")
+    else:
+        print("Dictionary trained, papers use it when next changed")
+
+
+def bench(args):
+    # encrypts the whole store in memory with each codec
+    store, pwd = unlock(args)
+    start = time.perf_counter()
+    texts = [i.text for i in store.decryptPapers()]
+    print("%d papers decrypted in %.3fs" % (len(texts),
+                                            time.perf_counter() - start))
+
+    samples = [i.encode() for i in texts]
+    variants = [('none', False), ('zlib', False), ('zlib', True)]
+    if zstandard is not None:
+        variants += [('zstd', False), ('zstd', True)]
+
+    for codec, use_dict in variants:
+        cipher = PaperCipher(store.key, codec)
+        if use_dict:
+            zdict = trainDictionary(cipher.codec, samples)
+            if not zdict:
+                continue
+            cipher.addDictionary(zdict)
+
+        files = []
+        start = time.perf_counter()
+        for i in texts:
+            f = io.BytesIO()
+            cipher.writeText(f, i)
+            files.append(f)
+        save_time = time.perf_counter() - start
+        written = sum(f.getbuffer().nbytes for f in files)
+
+        start = time.perf_counter()
+        for f in files:
+            cipher.readText(f.getvalue())
+        load_time = time.perf_counter() - start
+
+        name = codec + '+dict' if use_dict else codec
+        print("%-10s %12d bytes  save %.3fs  load %.3fs" %
+              (name, written, save_time, load_time))
+
+
+def ls(args):
+    # only the index is decrypted, not the papers
+    store, pwd = unlock(args)
+    for name, p in store.items():
+        if not p.meta:
+            print("%-20s %10s %8s %16s" % (name, '-', '-', '-'))
+            continue
+        mtime = '-'
+        if p.meta['mtime'] is not None:
+            mtime = time.strftime('%Y-%m-%d %H:%M',
+                                  time.localtime(p.meta['mtime']))
+        print("%-20s %10d %8d %16s  %s" % (name, p.meta['size'],
+                                           p.meta['words'], mtime,
+                                           p.meta['first_line']))
+
+
+def reindex(args):
+    store, pwd = unlock(args, use_index=False)
+    for name, rename in store.rebuildIndex().items():
+        print("%s -> %s" % (name, rename))
+    print("Index rebuilt for %d papers" % len(store))
+
+
+def compact(args):
+    store, pwd = unlock(args)
+    store.compact()
+
+
+def convert(args):
+    # copies the encrypted papers between layouts, the new layout only
+    # takes over once every paper has been copied
+    path = Path(args.path)
+    locks = StoreLock(path / Path('lock'))
+    with locks.store():
+        convertStorage(path, args.to)
+    locks.close()
+
+
+def convertStorage(path, to):
+    src = openStorage(path)
+    if src.kind == to:
+        sys.exit("Store is already " + to)
+    src.recover()
+    count = len(src.names())
+
+    # file based stores share the blob files next to the papers
+    blobs = src.kind == 'sqlite' or to == 'sqlite'
+    if to == 'packed':
+        dst = PackedStorage(path, 'convert')
+    elif to == 'sharded':
+        dst = ShardedStorage(path, 'convert')
+    elif to == 'sqlite':
+        dst = SqliteStorage(path, 'convert')
+    else:
+        dst = DirectoryStorage(path)
+    copyStorage(src, dst)
+    if to != 'directory':
+        dst.install('papers')
+    src.remove(blobs)
+    src.close()
+    dst.close()
+    print("%d papers converted" % count)
+
+
+def main():
+    config = PaperConfig()
+    parser = argparse.ArgumentParser(description="Paper store maintenance")
+    parser.add_argument('--path', default=config['Paper']['PapersPath'],
+                        help="papers store directory")
+    parser.set_defaults(compression=config['Paper']['Compression'],
+                        storage=config['Paper']['Storage'],
+                        kdf=config['Paper']['Kdf'],
+                        target=config['Paper'].getint('KdfTime'))
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    cmd = commands.add_parser('calibrate',
+                              help="pick KDF parameters for this machine")
+    cmd.add_argument('--kdf', choices=('pbkdf2', 'scrypt'),
+                     default=config['Paper']['Kdf'])
+    cmd.add_argument('--target', type=int,
+                     default=config['Paper'].getint('KdfTime'),
+                     help="unlock time in ms")
+    cmd.add_argument('--apply', action='store_true',
+                     help="rewrap the store key with the new parameters")
+    cmd.set_defaults(func=calibrate)
+
+    cmd = commands.add_parser('migrate',
+                              help="convert papers to the current format")
+    cmd.set_defaults(func=migrate)
+
+    cmd = commands.add_parser('train',
+                              help="train a compression dictionary")
+    cmd.set_defaults(func=train)
+
+    cmd = commands.add_parser('bench',
+                              help="compare bytes written and load times")
+    cmd.set_defaults(func=bench)
+
+    cmd = commands.add_parser('ls', help="list papers from the index")
+    cmd.set_defaults(func=ls)
+
+    cmd = commands.add_parser('reindex',
+                              help="rebuild the index from the papers")
+    cmd.set_defaults(func=reindex)
+
+    cmd = commands.add_parser('compact',
+                              help="reclaim space of a packed or sqlite store")
+    cmd.set_defaults(func=compact)
+
+    cmd = commands.add_parser('convert',
+                              help="switch the store layout")
+    cmd.add_argument('--to', required=True,
+                     choices=('directory', 'sharded', 'packed', 'sqlite'))
+    cmd.set_defaults(func=convert)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
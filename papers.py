@@ -1,130 +1,816 @@
-import os
-import base64
-
-from cryptography.fernet import Fernet, InvalidToken
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-
-from pathlib import Path
-
-
-class PapersStore (dict):
-
-    def __init__(self, papers_path):
-        super().__init__()
-        self.path = Path(papers_path)
-        self.initPath()
-        self.getSalt()
-
-    def initPath(self):
-        if not self.path.exists():
-            self.path.mkdir()
-        self.salt_path = self.path / Path('salt')
-        self.pw_check_path = self.path / Path('pw_check')
-        self.paper_files = [x for x in self.path.glob("*.ppr") if x.is_file()]
-
-    def get_key(self, pwd):
-        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),
-                         length=32,
-                         salt=self.salt,
-                         iterations=1000,
-                         backend=default_backend())
-        return base64.urlsafe_b64encode(kdf.derive(pwd.encode()))
-
-    def setPassword(self, pwd):
-        key = self.get_key(pwd)
-        fernet = Fernet(key)
-        if self.pw_check_path.exists():
-            btext = self.pw_check_path.read_bytes()
-        else:
-            return False
-
-        try:
-            text = fernet.decrypt(btext).decode()
-        except InvalidToken:
-            return False
-        else:
-            self.key = key
-            self.fernet = fernet
-            return True
-
-    def changePassword(self, pwd):
-        self.getSalt(True)
-        self.key = self.get_key(pwd)
-        self.fernet = Fernet(self.key)
-
-        # write pw_check
-        text = "".encode()
-        cbtext = self.fernet.encrypt(text)
-        self.pw_check_path.write_bytes(cbtext)
-
-        self.saveAllPapers()
-
-    def getSalt(self, new=False):
-        if self.salt_path.exists() and not new:
-            self.salt = base64.urlsafe_b64decode(self.salt_path.read_bytes())
-        else:
-            self.salt = os.urandom(16)
-            salt64 = base64.urlsafe_b64encode(self.salt)
-            self.salt_path.write_bytes(salt64)
-
-    def loadPapers(self):
-        for i in self.paper_files:
-            p = Paper()
-            btext = i.read_bytes()
-            try:
-                p.text = self.fernet.decrypt(btext).decode()
-                p.name = i.stem
-                p.filename = i.name
-                self[p.name] = (p)
-            except InvalidToken:
-                raise ValueError("Invalid Password")
-
-    def addPaper(self, name):
-        if name not in self:
-            p = Paper()
-            p.name = name
-            p.filename = name + '.ppr'
-            self[name] = p
-            self.savePaper(name)
-            return True
-        else:
-            return False
-
-    def renamePaper(self, name, rename):
-        if rename not in self:
-            p = self[name]
-            pth = self.path / Path(name)
-            new_pth = self.path / Path(rename)
-            pth.rename(new_pth)
-            del self[name]
-            self[rename] = p
-            return True
-        else:
-            return False
-
-    def deletePaper(self, name):
-        os.remove(self.path / Path(self[name].filename))
-        del self[name]
-
-    def savePaper(self, name):
-        ppr = self[name]
-        p = self.path / Path(ppr.filename)
-        btext = ppr.text.encode()
-        cbtext = self.fernet.encrypt(btext)
-        p.write_bytes(cbtext)
-
-    def saveAllPapers(self):
-        for i in self:
-            self.savePaper(i)
-
-    def paperExists(self, name):
-        p = self.path / Path(name)
-        return p.exists()
-
-
-class Paper:
-    text = ""
-    name = ""
-    filename = ""
+import io
+import os
+import re
+import json
+import time
+import uuid
+import base64
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+from pathlib import Path
+
+from storage import openStorage, StoreLock
+from container import PaperCipher, CODECS, trainDictionary
+
+HEADER_VERSION = 2
+
+# papers with at least this many chunks are rewritten in place
+PARTIAL_CHUNKS = 16
+
+# parameters of headers written before the kdf was recorded
+LEGACY_KDF = {'name': 'pbkdf2', 'iterations': 1000}
+
+# ids given to new papers, older papers use their name
+PAPER_ID = re.compile('[0-9a-f]{32}')
+FIRST_LINE_LENGTH = 80
+
+
+def makeKdf(salt, params):
+    if params['name'] == 'pbkdf2':
+        return PBKDF2HMAC(algorithm=hashes.SHA256(),
+                          length=32,
+                          salt=salt,
+                          iterations=params['iterations'],
+                          backend=default_backend())
+    elif params['name'] == 'scrypt':
+        return Scrypt(salt=salt,
+                      length=32,
+                      n=params['n'],
+                      r=params['r'],
+                      p=params['p'],
+                      backend=default_backend())
+    else:
+        raise ValueError("Unknown KDF " + params['name'])
+
+
+def timeKdf(params, rounds=3):
+    salt = os.urandom(16)
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        makeKdf(salt, params).derive(b'calibration')
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def paperMeta(text, mtime=None):
+    # what the index keeps about a paper besides its name
+    first_line = text.split('\n', 1)[0]
+    return {'size': len(text.encode()),
+            'mtime': mtime,
+            'words': len(text.split()),
+            'first_line': first_line[:FIRST_LINE_LENGTH]}
+
+
+def calibrateKdf(name='pbkdf2', target=0.25):
+    # pick parameters so one derivation takes about target seconds here
+    if name == 'pbkdf2':
+        params = {'name': 'pbkdf2', 'iterations': 10000}
+        elapsed = timeKdf(params)
+        params['iterations'] = max(10000, int(10000 * target / elapsed))
+    elif name == 'scrypt':
+        params = {'name': 'scrypt', 'n': 2 ** 14, 'r': 8, 'p': 1}
+        # cost doubles with n, stop at 256 MiB of memory
+        while params['n'] < 2 ** 18 and timeKdf(params, 1) * 2 <= target:
+            params['n'] *= 2
+    else:
+        raise ValueError("Unknown KDF " + name)
+    return params
+
+
+class PapersStore (dict):
+
+    def __init__(self, papers_path, compression='zlib', storage='directory',
+                 kdf='pbkdf2', kdf_time=0.25):
+        super().__init__()
+        self.path = Path(papers_path)
+        self.compression = compression
+        self.storage_kind = storage
+        # KDF and unlock time in seconds for keys wrapped without given
+        # parameters
+        self.kdf = kdf
+        self.kdf_time = kdf_time
+        self.cipher = None
+        # papers written and saves skipped as unchanged
+        self.writes = 0
+        self.skipped = 0
+        # papers may be saved from a worker thread
+        self.lock = threading.RLock()
+        # ids of papers deleted here, kept out of the index when it is
+        # merged with the stored one
+        self.deleted = set()
+        # the index as this process last read or wrote it, and its
+        # entries then, which tell our own changes from those of other
+        # processes. None means the index is rebuilt from our papers
+        self.index_blob = None
+        self.index_base = {}
+        self.initPath()
+        self.readHeader()
+
+    def initPath(self):
+        self.storage = openStorage(self.path, self.storage_kind)
+        # shared with other processes using the store
+        self.locks = StoreLock(self.storage.lockPath())
+        with self.locks.store():
+            self.storage.recover()
+
+    def readHeader(self):
+        data = self.storage.readBlob('header')
+        if data is not None:
+            self.header = json.loads(data)
+            if self.header['version'] > HEADER_VERSION:
+                raise ValueError("Unsupported store version")
+        else:
+            self.header = None
+
+    def writeHeader(self):
+        self.storage.writeBlob('header', json.dumps(self.header).encode())
+
+    def hasPassword(self):
+        # pre-header stores keep a salt and pw_check blob instead
+        return self.header is not None or \
+            self.storage.readBlob('pw_check') is not None
+
+    def get_key(self, pwd, salt, kdf):
+        key = makeKdf(salt, kdf).derive(pwd.encode())
+        return base64.urlsafe_b64encode(key)
+
+    def setPassword(self, pwd):
+        # the store may have been rewrapped while it was locked
+        self.readHeader()
+        if self.header is None:
+            return self.migrateStore(pwd)
+
+        salt = base64.urlsafe_b64decode(self.header['salt'])
+        kdf = self.header.get('kdf', LEGACY_KDF)
+        kek = Fernet(self.get_key(pwd, salt, kdf))
+        try:
+            key = kek.decrypt(self.header['key'].encode())
+        except InvalidToken:
+            return False
+        if 'previous' in self.header:
+            self.finishMigration(pwd, key,
+                                 kek.decrypt(self.header['previous'].encode()))
+        else:
+            self.setKey(key)
+        return True
+
+    def changePassword(self, pwd, kdf=None):
+        # papers are encrypted with a random data key, only its wrapped
+        # copy in the header depends on the password
+        with self.lock, self.locks.store():
+            if self.cipher is None:
+                # another process may have just created the store
+                self.readHeader()
+                if self.hasPassword():
+                    raise ValueError("Store is locked")
+                self.setKey(Fernet.generate_key())
+
+            if kdf is None:
+                if self.header is not None and 'kdf' in self.header:
+                    kdf = self.header['kdf']
+                else:
+                    kdf = calibrateKdf(self.kdf, self.kdf_time)
+            self.wrapKey(pwd, kdf)
+
+    def setKey(self, key):
+        self.key = key
+        self.cipher = PaperCipher(key, self.compression)
+        self.loadDictionaries()
+
+    def wrapKey(self, pwd, kdf, previous=None):
+        # the wrapped key doubles as the password check
+        salt = os.urandom(16)
+        kek = Fernet(self.get_key(pwd, salt, kdf))
+        self.header = {'version': HEADER_VERSION,
+                       'kdf': kdf,
+                       'salt': base64.urlsafe_b64encode(salt).decode(),
+                       'key': kek.encrypt(self.key).decode()}
+        if previous is not None:
+            self.header['previous'] = kek.encrypt(previous).decode()
+        self.writeHeader()
+
+    def migrateStore(self, pwd):
+        # papers of a pre-header store are encrypted with the password
+        # derived key itself, a weak key that must not outlive the old
+        # password, so they are encrypted again under a new data key
+        pw_check = self.storage.readBlob('pw_check')
+        if pw_check is None:
+            return False
+
+        salt = base64.urlsafe_b64decode(self.storage.readBlob('salt'))
+        key = self.get_key(pwd, salt, LEGACY_KDF)
+        try:
+            Fernet(key).decrypt(pw_check)
+        except InvalidToken:
+            return False
+
+        with self.lock, self.locks.store():
+            # another process may have migrated the store meanwhile
+            self.readHeader()
+            if self.header is None:
+                self.key = Fernet.generate_key()
+                self.wrapKey(pwd, calibrateKdf(self.kdf, self.kdf_time), key)
+        return self.setPassword(pwd)
+
+    def finishMigration(self, pwd, key, previous):
+        # the header keeps the legacy key until every paper is encrypted
+        # under the new one, an interrupted run is finished on next unlock
+        with self.lock, self.locks.store():
+            self.readHeader()
+            self.setKey(key)
+            if 'previous' not in self.header:
+                return
+            old = PaperCipher(previous, self.compression)
+            with self.storage.batch():
+                for i in self.storage.names():
+                    with self.storage.view(i) as view:
+                        try:
+                            self.cipher.readText(view)
+                            continue
+                        except InvalidToken:
+                            pass
+                        try:
+                            text = old.readText(view)[0]
+                        except InvalidToken:
+                            raise ValueError("Paper " + i + " is damaged")
+                    self.writePaperFile(i, text)
+            self.wrapKey(pwd, self.header['kdf'])
+            self.storage.deleteBlob('pw_check')
+            self.storage.deleteBlob('salt')
+
+    def loadDictionaries(self):
+        btext = self.storage.readBlob('dictionaries')
+        if btext is None:
+            return
+        try:
+            data = json.loads(self.cipher.fernet.decrypt(btext))
+        except InvalidToken:
+            raise ValueError("Invalid Password")
+        for i in data['dictionaries']:
+            dict_id = self.cipher.addDictionary(base64.b64decode(i), False)
+            if dict_id == data['active']:
+                self.cipher.dictionary = dict_id
+
+    def saveDictionaries(self):
+        data = {'active': self.cipher.dictionary,
+                'dictionaries': [base64.b64encode(i).decode()
+                                 for i in self.cipher.dictionaries.values()]}
+        btext = self.cipher.fernet.encrypt(json.dumps(data).encode())
+        self.storage.writeBlob('dictionaries', btext)
+
+    def trainDictionary(self):
+        # builds a compression dictionary from the store's own papers,
+        # papers saved afterwards use it, older ones keep theirs
+        if self.cipher.codec == CODECS['none']:
+            return None
+        samples = [i.text.encode() for i in self.decryptPapers()]
+        zdict = trainDictionary(self.cipher.codec, samples)
+        if not zdict:
+            return None
+        with self.lock, self.locks.store():
+            # keeps dictionaries other processes added meanwhile
+            self.loadDictionaries()
+            dict_id = self.cipher.addDictionary(zdict)
+            self.saveDictionaries()
+        return dict_id
+
+    def readIndex(self):
+        # returns the stored index blob and its entries
+        btext = self.storage.readBlob('index')
+        if btext is None:
+            return None, {}
+        try:
+            data = json.loads(self.cipher.fernet.decrypt(btext))
+        except (InvalidToken, ValueError):
+            raise ValueError("Damaged paper index, run paper_tool.py reindex")
+        return btext, data['papers']
+
+    def loadIndex(self):
+        # paper id -> name and metadata, in tab order. papers stored
+        # before the index are not in it, their id is the name they were
+        # saved under
+        self.index_blob, index = self.readIndex()
+        self.index_base = index
+        return index
+
+    def indexEntries(self):
+        return {p.id: dict(p.meta or {}, name=p.name) for p in self.values()}
+
+    def mergeIndex(self, ours, stored):
+        # names, metadata and the order we changed since the index was
+        # read win, everything else is taken from the stored index
+        base = self.index_base
+        if base is None:
+            return ours
+        if [i for i in ours if i in base] != [i for i in base if i in ours]:
+            order = list(ours) + [i for i in stored if i not in ours]
+        else:
+            order = list(stored) + [i for i in ours if i not in stored]
+
+        papers = {}
+        for i in order:
+            if i in self.deleted:
+                continue
+            if i not in ours:
+                papers[i] = stored[i]
+            elif i not in base:
+                papers[i] = ours[i]
+            elif i not in stored:
+                # deleted by another process, unless we changed it since
+                if ours[i] != base[i]:
+                    papers[i] = ours[i]
+            else:
+                mine = dict(ours[i])
+                was = dict(base[i])
+                entry = dict(stored[i])
+                name = entry.pop('name')
+                if mine.pop('name') != was.pop('name'):
+                    name = ours[i]['name']
+                if mine != was:
+                    entry = mine
+                papers[i] = dict(entry, name=name)
+        return papers
+
+    def saveIndex(self):
+        # merges our changes into the stored index, returns False without
+        # writing it when a name we gave a paper is taken by another one
+        with self.locks.index():
+            try:
+                stored_blob, stored = self.readIndex()
+            except ValueError:
+                stored_blob = None
+            ours = self.indexEntries()
+            if stored_blob is None:
+                # nothing to merge with, our papers make up the index
+                stored = ours
+            papers = self.mergeIndex(ours, stored)
+
+            base = self.index_base or {}
+            names = {}
+            for i, entry in papers.items():
+                other = names.setdefault(entry['name'], i)
+                if other == i:
+                    continue
+                for j in (i, other):
+                    if j in ours and (j not in base or
+                                      ours[j]['name'] != base[j]['name']):
+                        return False
+
+            data = {'papers': papers}
+            btext = self.cipher.fernet.encrypt(json.dumps(data).encode())
+            self.storage.writeBlob('index', btext)
+            # changes merged in from another process still need a reload
+            if stored_blob == self.index_blob:
+                self.index_blob = btext
+            if self.index_base is not None:
+                self.index_base = ours
+            return True
+
+    def checkVersion(self, paper):
+        # a paper another process wrote or deleted since we read it is not
+        # overwritten, it has to be reloaded first
+        if paper.version is None:
+            return
+        self.storage.refresh()
+        try:
+            version = self.storage.version(paper.id)
+        except FileNotFoundError:
+            version = None
+        if version != paper.version:
+            raise ValueError("Paper " + paper.name +
+                             " was changed by another program")
+
+    def listPapers(self, index):
+        # yields (id, name, metadata) of every stored paper in index order
+        self.storage.refresh()
+        ids = set(self.storage.names())
+        for i in list(index) + sorted(ids - set(index)):
+            if i not in ids:
+                continue
+            meta = None
+            name = i
+            if i in index:
+                meta = dict(index[i])
+                name = meta.pop('name')
+                # papers never saved since the index exists only have
+                # their name in it
+                meta = meta or None
+            yield i, name, meta
+
+    def loadPapers(self, use_index=True):
+        # only list papers here, bodies are decrypted on first access
+        if use_index:
+            index = self.loadIndex()
+        else:
+            index = {}
+            self.index_base = None
+        for i, name, meta in self.listPapers(index):
+            if name not in self:
+                self[name] = Paper(name, self, i)
+                self[name].meta = meta
+
+    def reloadPapers(self):
+        # picks up changes another process made to the store. returns the
+        # names of added papers, the removed papers, (old, new) names of
+        # renamed ones and the names of loaded papers decrypted again
+        with self.lock:
+            # papers may use a dictionary another process trained
+            self.loadDictionaries()
+            papers = {p.id: p for p in self.values()}
+            found = {}
+            added = []
+            renamed = []
+            btext = self.storage.readBlob('index')
+            if btext is not None and btext == self.index_blob:
+                # every other writer rewrites the index, so only our own
+                # saves happened and the papers need not be listed again
+                self.storage.refresh()
+                listing = [(p.id, p.name, p.meta) for p in self.values()]
+            else:
+                listing = self.listPapers(self.loadIndex())
+            for i, name, meta in listing:
+                if name in found:
+                    continue
+                p = papers.pop(i, None)
+                if p is None:
+                    p = Paper(name, self, i)
+                    added.append(name)
+                elif p.name != name:
+                    renamed.append((p.name, name))
+                    p.name = name
+                p.meta = meta
+                found[name] = p
+
+            changed = []
+            for p in found.values():
+                if p.loaded and self.storage.version(p.id) != p.version:
+                    p.text = self.decryptPaper(p)
+                    changed.append(p.name)
+
+            self.clear()
+            self.update(found)
+            return added, list(papers.values()), renamed, changed
+
+    def restorePaper(self, paper):
+        # writes back a paper that another process deleted
+        with self.lock:
+            if paper.name in self:
+                return False
+            paper.chunks = None
+            paper.digest = None
+            paper.version = None
+            self[paper.name] = paper
+            if not self.saveIndex():
+                del self[paper.name]
+                return False
+            self.savePaper(paper.name)
+            return True
+
+    def watchPaths(self):
+        return self.storage.watchPaths([p.id for p in self.values()
+                                        if p.loaded])
+
+    def rebuildIndex(self):
+        # recomputes the metadata from the paper bodies, papers whose
+        # name was lost with the index are named after their first line
+        with self.lock, self.locks.store():
+            for p in self.decryptPapers():
+                p.meta = paperMeta(p.text, p.meta and p.meta['mtime'])
+
+            renames = {}
+            taken = set(self)
+            for name, p in self.items():
+                if name != p.id or not PAPER_ID.fullmatch(p.id):
+                    continue
+                title = p.meta['first_line'].strip('# \t') or name
+                rename = title
+                count = 1
+                while rename in taken:
+                    count += 1
+                    rename = "%s (%d)" % (title, count)
+                taken.add(rename)
+                renames[name] = rename
+            self.renamePapers(renames)
+            return renames
+
+    def decryptPaper(self, paper):
+        # large papers are rewritten in place, so the paper is locked
+        # against writers for as long as its file is mapped
+        try:
+            with self.locks.store(False), \
+                    self.locks.papers([paper.id], False):
+                paper.version = self.storage.version(paper.id)
+                with self.storage.view(paper.id) as view:
+                    text, paper.chunks, paper.digest = \
+                        self.cipher.readText(view)
+        except InvalidToken:
+            # the header already checked the password
+            raise ValueError("Paper " + paper.name + " is damaged")
+        except (FileNotFoundError, KeyError):
+            # gone without the index saying so, the next reload lists
+            # the papers again
+            self.index_blob = None
+            raise
+        return text
+
+    def writePaperFile(self, paper_id, text, chunks=None):
+        # large papers are updated in place from their first changed
+        # chunk when the storage allows it, otherwise they are replaced
+        partial = self.storage.partial and chunks is not None and \
+            len(chunks) >= PARTIAL_CHUNKS
+        with self.storage.writer(paper_id, partial) as f:
+            return self.cipher.writeText(f, text, chunks if partial else None)
+
+    def encryptPaper(self, paper, text):
+        # returns the digest, chunks and encrypted body of text, or None
+        # when the paper already holds it
+        digest = self.cipher.textDigest(text)
+        if digest == paper.digest:
+            return None
+        f = io.BytesIO()
+        chunks = self.cipher.writeText(f, text)[0]
+        return digest, chunks, f.getbuffer()
+
+    def upgradePapers(self):
+        # rewrites papers in older formats one at a time, yielding
+        # the name of each converted paper
+        names = {p.id: p.name for p in self.values()}
+        with self.locks.store():
+            for i in self.storage.names():
+                with self.storage.view(i) as view:
+                    if self.cipher.isCurrent(view):
+                        continue
+                    try:
+                        text = self.cipher.readText(view)[0]
+                    except InvalidToken:
+                        raise ValueError("Paper " + names.get(i, i) +
+                                         " is damaged")
+                self.writePaperFile(i, text)
+                yield names.get(i, i)
+
+    def decryptPapers(self, workers=None):
+        # yields every paper, decrypting pending ones on a thread pool
+        # in the order they finish
+        pending = []
+        for i in list(self.values()):
+            if i.loaded:
+                yield i
+            else:
+                pending.append(i)
+        if not pending:
+            return
+
+        pool = ThreadPoolExecutor(workers)
+        try:
+            futures = {pool.submit(self.decryptPaper, i): i for i in pending}
+            for f in as_completed(futures):
+                p = futures[f]
+                if not p.loaded:
+                    p.text = f.result()
+                yield p
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def addPaper(self, name):
+        # the index is written first, an entry without a paper behind it
+        # is dropped the next time papers are listed
+        with self.lock:
+            if name in self:
+                return False
+            p = Paper(name, paper_id=uuid.uuid4().hex)
+            self[name] = p
+            if not self.saveIndex():
+                del self[name]
+                return False
+            self.savePaper(name)
+            return True
+
+    def renamePaper(self, name, rename):
+        return self.renamePapers({name: rename})
+
+    def renamePapers(self, renames):
+        # names only live in the index, so any number of papers is
+        # renamed with one index write
+        with self.lock:
+            renamed = list(renames.values())
+            kept = [i for i in self if i not in renames]
+            if len(set(renamed)) != len(renamed) or \
+                    any(i in kept for i in renamed):
+                return False
+
+            order = [renames.get(i, i) for i in self]
+            old = dict(self)
+            for name, rename in renames.items():
+                self[name].name = rename
+            papers = {p.name: p for p in self.values()}
+            self.clear()
+            self.update((i, papers[i]) for i in order)
+            if not self.saveIndex():
+                # another process already uses one of the names
+                for name, p in old.items():
+                    p.name = name
+                self.clear()
+                self.update(old)
+                return False
+            return True
+
+    def reorderPapers(self, names):
+        # names lists the papers in their new order
+        with self.lock:
+            papers = dict(self)
+            self.clear()
+            self.update((i, papers.pop(i)) for i in names)
+            self.update(papers)
+            self.saveIndex()
+
+    def deletePaper(self, name):
+        with self.lock:
+            paper_id = self[name].id
+            with self.locks.store(False), self.locks.papers([paper_id]):
+                self.storage.delete(paper_id)
+            del self[name]
+            self.deleted.add(paper_id)
+            self.saveIndex()
+
+    def savePaper(self, name, text=None):
+        # returns whether the paper had to be written, text replaces the
+        # paper's text first
+        with self.lock:
+            ppr = self[name]
+            if text is not None:
+                ppr.text = text
+            if not ppr.loaded:
+                self.skipped += 1
+                return False
+
+            digest = self.cipher.textDigest(ppr.text)
+            if digest == ppr.digest:
+                self.skipped += 1
+                return False
+
+            with self.locks.store(False), self.locks.papers([ppr.id]):
+                self.checkVersion(ppr)
+                ppr.chunks = self.writePaperFile(ppr.id, ppr.text,
+                                                 ppr.chunks)[0]
+                ppr.version = self.storage.version(ppr.id)
+            ppr.digest = digest
+            ppr.meta = paperMeta(ppr.text, time.time())
+            self.saveIndex()
+            self.writes += 1
+            return True
+
+    def saveAllPapers(self):
+        with self.transaction() as t:
+            for i in self:
+                t.save(i)
+        return t.written
+
+    @contextmanager
+    def transaction(self, workers=None):
+        # papers saved or deleted in the block are written together when
+        # it exits, nothing is written if it raises
+        with self.lock:
+            t = Transaction(self)
+            yield t
+            t.commit(workers)
+
+    def paperExists(self, name):
+        return name in self
+
+    def compact(self):
+        with self.lock, self.locks.store():
+            self.storage.compact()
+
+    def closePapers(self):
+        # forgets the key and every paper, the storage stays open so the
+        # next unlock does not list the store from scratch
+        with self.lock:
+            self.clear()
+            self.cipher = None
+            self.key = None
+
+    def close(self):
+        with self.lock:
+            self.storage.close()
+            self.locks.close()
+
+
+class Transaction:
+
+    def __init__(self, store):
+        self.store = store
+        # name -> True to save the paper, False to delete it
+        self.changes = {}
+        self.written = 0
+
+    def save(self, name, text=None):
+        ppr = self.store[name]
+        if text is not None:
+            ppr.text = text
+        self.changes[name] = True
+
+    def delete(self, name):
+        if name not in self.store:
+            raise KeyError(name)
+        self.changes[name] = False
+
+    def commit(self, workers=None):
+        store = self.store
+        saves = []
+        for name, save in self.changes.items():
+            if not save:
+                continue
+            if store[name].loaded:
+                saves.append(store[name])
+            else:
+                store.skipped += 1
+
+        # encrypting is the slow part, only the writes are serialized
+        if len(saves) > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                results = list(pool.map(
+                    lambda i: store.encryptPaper(i, i.text), saves))
+        else:
+            results = [store.encryptPaper(i, i.text) for i in saves]
+
+        written = []
+        ids = [store[i].id for i in self.changes]
+        with store.locks.store(False), store.locks.papers(ids):
+            # nothing is written if any paper changed elsewhere
+            for ppr, result in zip(saves, results):
+                if result is not None:
+                    store.checkVersion(ppr)
+
+            with store.storage.batch():
+                for ppr, result in zip(saves, results):
+                    if result is None:
+                        store.skipped += 1
+                        continue
+                    with store.storage.writer(ppr.id) as f:
+                        f.write(result[2])
+                    written.append((ppr, result))
+                for name, save in self.changes.items():
+                    if not save:
+                        store.storage.delete(store[name].id)
+
+            for ppr, result in written:
+                ppr.version = store.storage.version(ppr.id)
+
+        mtime = time.time()
+        for ppr, (digest, chunks, data) in written:
+            ppr.digest = digest
+            ppr.chunks = chunks
+            ppr.meta = paperMeta(ppr.text, mtime)
+        deleted = [i for i in self.changes if not self.changes[i]]
+        for name in deleted:
+            store.deleted.add(store[name].id)
+            del store[name]
+        if written or deleted:
+            store.saveIndex()
+        self.written = len(written)
+        store.writes += self.written
+
+
+class Paper:
+
+    def __init__(self, name="", store=None, paper_id=None):
+        self.name = name
+        self.store = store
+        # key of the paper in the storage, stays the same across renames
+        self.id = name if paper_id is None else paper_id
+        # size, mtime, words and first_line from the index, None until
+        # the paper is saved or the index rebuilt
+        self.meta = None
+        # storage version of the text last loaded or saved
+        self.version = None
+        # (offset, digest) of each chunk in the paper file
+        self.chunks = None
+        # keyed hash of the text last loaded or saved
+        self.digest = None
+        # None until the body has been decrypted from the store
+        self._text = None if store is not None else ""
+
+    @property
+    def loaded(self):
+        return self._text is not None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.store.decryptPaper(self)
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self._text = text
@@ -0,0 +1,74 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+class SaveWorker(QObject):
+    # paper name, document revision that was saved, error message
+    saved = pyqtSignal(str, int, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # a single thread keeps saves of one paper in order
+        self.pool = ThreadPoolExecutor(1)
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def save(self, papers, name, text, revision):
+        self.saveBatch(papers, [(name, text, revision)])
+
+    def saveBatch(self, papers, batch):
+        # batch holds (name, text, revision) snapshots taken on the GUI
+        # thread and is written in one go, a save queued for the same
+        # paper that has not started yet is replaced
+        names = []
+        with self.lock:
+            for name, text, revision in batch:
+                if name not in self.pending:
+                    names.append(name)
+                self.pending[name] = (papers, text, revision)
+        if names:
+            self.pool.submit(self.run, names)
+
+    def run(self, names):
+        with self.lock:
+            jobs = [(i,) + self.pending.pop(i) for i in names]
+
+        if len(jobs) > 1:
+            self.runBatch(jobs)
+            return
+
+        for job in jobs:
+            self.runJob(*job)
+
+    def runJob(self, name, papers, text, revision):
+        error = ''
+        try:
+            with papers.lock:
+                if name in papers:
+                    papers.savePaper(name, text)
+        except (OSError, ValueError) as e:
+            error = str(e)
+        self.saved.emit(name, revision, error)
+
+    def runBatch(self, jobs):
+        # the papers of a batch are committed in one transaction, if it
+        # fails they are saved one by one so a paper that cannot be
+        # written does not hold back the others
+        papers = jobs[0][1]
+        try:
+            with papers.transaction() as t:
+                for name, store, text, revision in jobs:
+                    if name in papers:
+                        t.save(name, text)
+        except (OSError, ValueError):
+            for job in jobs:
+                self.runJob(*job)
+            return
+        for name, store, text, revision in jobs:
+            self.saved.emit(name, revision, '')
+
+    def wait(self):
+        # blocks until every queued save has been written
+        self.pool.submit(lambda: None).result()
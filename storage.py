@@ -0,0 +1,1102 @@
+import io
+import os
+import json
+import mmap
+import shutil
+import struct
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext, ExitStack
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from pathlib import Path
+
+# packed store: one append-only segment file
+#   magic 'PPK' | version (1 byte) | generation (8 bytes)
+# followed by records
+#   kind (1 byte) | name length (2 bytes) | data length (8 bytes) | name | data
+# a put record holds an encrypted paper, a rename record the new name.
+# records between a begin and a commit record only apply together
+# the .idx file caches name -> [offset, length, version] up to some size
+# of the segment, records past it are scanned when the store is opened
+PACK_MAGIC = b'PPK\x01'
+PACK_HEAD = struct.Struct('>4sQ')
+RECORD_HEAD = struct.Struct('>BHQ')
+PENDING, PUT, DELETE, RENAME, BEGIN, COMMIT = 0, 1, 2, 3, 4, 5
+
+# records appended before the index file is rewritten
+INDEX_INTERVAL = 64
+COPY_SIZE = 1024 * 1024
+
+# store wide data kept next to the papers
+BLOB_NAMES = ('header', 'dictionaries', 'index', 'salt', 'pw_check')
+
+# a directory store batch is committed once its intent file is in place,
+# paper files end in .ppr so the suffix cannot clash with a paper's name
+INTENT_SUFFIX = '.intent'
+
+# bytes of the store's lock file, papers lock one of LOCK_SLOTS bytes
+# after PAPER_LOCKS picked by a hash of their id
+STORE_LOCK = 0
+INDEX_LOCK = 1
+PAPER_LOCKS = 2
+LOCK_SLOTS = 2 ** 20
+
+
+def openStorage(path, kind='directory'):
+    # an existing store keeps its layout, kind only applies to new ones
+    if kind == 'memory':
+        return MemoryStorage()
+
+    if not path.exists():
+        path.mkdir()
+    if (path / Path('papers.pack')).exists():
+        return PackedStorage(path)
+    if (path / Path('papers.db')).exists():
+        return SqliteStorage(path)
+    if (path / Path('papers')).is_dir():
+        return ShardedStorage(path)
+    if kind in ('packed', 'sqlite', 'sharded') and \
+            not any(path.glob("*.ppr")):
+        if kind == 'packed':
+            return PackedStorage(path)
+        if kind == 'sharded':
+            return ShardedStorage(path)
+        return SqliteStorage(path)
+    return DirectoryStorage(path)
+
+
+def copyStorage(src, dst):
+    # copies the encrypted papers as they are, no key is needed
+    with dst.batch():
+        for name in src.names():
+            with src.open(name) as r, dst.writer(name) as w:
+                data = r.read(COPY_SIZE)
+                while data:
+                    w.write(data)
+                    data = r.read(COPY_SIZE)
+
+        for name in BLOB_NAMES:
+            data = src.readBlob(name)
+            if data is not None and data != dst.readBlob(name):
+                dst.writeBlob(name, data)
+
+
+def syncDirectory(path):
+    # makes renames in path durable, directories cannot be opened on windows
+    if os.name != 'posix':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncFile(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+@contextmanager
+def mapFile(path, offset=0, length=None):
+    # yields a read only view of the file, pages are only read once the
+    # view is accessed
+    with path.open('rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            yield memoryview(b'')
+            return
+
+    view = memoryview(mm)
+    try:
+        if length is None:
+            yield view
+        else:
+            yield view[offset:offset + length]
+    finally:
+        view.release()
+        try:
+            mm.close()
+        except BufferError:
+            # a slice is still referenced, the mapping goes with it
+            pass
+
+
+class StoreLock:
+    # advisory locks shared by every process using a store. store wide
+    # changes hold the store byte exclusively while paper writes share
+    # it, the index and each paper have a byte of their own. these are
+    # posix record locks, which belong to the process and are dropped
+    # when any of its descriptors of the file is closed, so a store keeps
+    # one StoreLock and nested requests for a byte are counted, also
+    # across the threads papers are read on
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.held = {}
+        self.pending = set()
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def hold(self, offset, exclusive=True):
+        if fcntl is None or self.path is None:
+            yield
+            return
+
+        with self.cond:
+            # another thread may be taking the byte, and a shared byte is
+            # only made exclusive once this process stops reading under it
+            while True:
+                count, held = self.held.get(offset, (0, False))
+                if offset in self.pending or count and exclusive and not held:
+                    self.cond.wait()
+                else:
+                    break
+            if self.f is None:
+                self.f = open(self.path, 'a+b')
+            if count == 0:
+                self.pending.add(offset)
+            else:
+                self.held[offset] = (count + 1, held)
+        if count == 0:
+            mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            taken = False
+            try:
+                fcntl.lockf(self.f, mode, 1, offset)
+                taken = True
+            finally:
+                with self.cond:
+                    if taken:
+                        self.held[offset] = (1, exclusive)
+                    self.pending.discard(offset)
+                    self.cond.notify_all()
+        try:
+            yield
+        finally:
+            with self.cond:
+                count, held = self.held.pop(offset)
+                if count > 1:
+                    self.held[offset] = (count - 1, held)
+                else:
+                    fcntl.lockf(self.f, fcntl.LOCK_UN, 1, offset)
+                    self.cond.notify_all()
+
+    def store(self, exclusive=True):
+        return self.hold(STORE_LOCK, exclusive)
+
+    def index(self):
+        return self.hold(INDEX_LOCK)
+
+    @contextmanager
+    def papers(self, names, exclusive=True):
+        # bytes are always taken in the same order so two writers of the
+        # same papers cannot deadlock
+        slots = set()
+        for i in names:
+            digest = hashlib.blake2b(i.encode(), digest_size=4).digest()
+            slot = int.from_bytes(digest, 'big') % LOCK_SLOTS
+            slots.add(PAPER_LOCKS + slot)
+        with ExitStack() as stack:
+            for i in sorted(slots):
+                stack.enter_context(self.hold(i, exclusive))
+            yield
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            self.held = {}
+
+
+class Storage:
+    # keeps the encrypted papers by name and a few store wide blobs,
+    # writer yields a file the paper is written into
+    kind = None
+    partial = False
+
+    def names(self):
+        raise NotImplementedError
+
+    def exists(self, name):
+        return name in self.names()
+
+    def open(self, name):
+        with self.view(name) as view:
+            return io.BytesIO(view)
+
+    def view(self, name):
+        raise NotImplementedError
+
+    def writer(self, name, partial=False):
+        raise NotImplementedError
+
+    def rename(self, name, rename):
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def readBlob(self, name):
+        raise NotImplementedError
+
+    def writeBlob(self, name, data):
+        raise NotImplementedError
+
+    def deleteBlob(self, name):
+        raise NotImplementedError
+
+    def batch(self):
+        # groups writes and deletes, they are committed together when
+        # the block exits and dropped if it raises
+        return nullcontext()
+
+    def refresh(self):
+        # picks up changes made by another process
+        pass
+
+    def recover(self):
+        # finishes or drops writes a crash interrupted, only safe while
+        # no other process is writing
+        pass
+
+    def version(self, name):
+        # changes whenever the paper is written, None if not tracked
+        return None
+
+    def lockPath(self):
+        # file the store's advisory locks are taken on
+        return None
+
+    def watchPaths(self, names):
+        # files and directories that change when the given papers or the
+        # list of papers change
+        return []
+
+    def compact(self):
+        pass
+
+    def install(self, name):
+        # moves a storage created under another name to its final one
+        raise NotImplementedError
+
+    def remove(self, blobs=True):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileStorage(Storage):
+    # blobs are plain files in the store directory
+
+    def __init__(self, path):
+        self.path = path
+
+    def lockPath(self):
+        return self.path / Path('lock')
+
+    def readBlob(self, name):
+        p = self.path / Path(name)
+        if p.exists():
+            return p.read_bytes()
+        return None
+
+    def writeBlob(self, name, data):
+        p = self.path / Path(name)
+        tmp_path = p.with_name(p.name + '.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, p)
+
+    def deleteBlob(self, name):
+        (self.path / Path(name)).unlink(missing_ok=True)
+
+    def removeBlobs(self):
+        for name in BLOB_NAMES:
+            self.deleteBlob(name)
+
+
+class DirectoryStorage(FileStorage):
+    # one .ppr file per paper, files can be updated in place outside of
+    # a batch
+    kind = 'directory'
+    # directory levels between the papers directory and the files
+    depth = 0
+
+    def __init__(self, path):
+        super().__init__(path)
+        # name -> True for a staged write, False for a staged delete
+        self.staged = None
+        # directory -> whether its listing was current when the open
+        # batch first touched it
+        self.staged_dirs = None
+        # directory -> (mtime, entries) found by its last scan
+        self.listing = {}
+
+    @property
+    def partial(self):
+        return self.staged is None
+
+    def paperRoot(self):
+        return self.path
+
+    def paperDir(self, name):
+        return self.path
+
+    def paperDirs(self):
+        return [self.path]
+
+    def paperPath(self, name):
+        return self.paperDir(name) / Path(name + '.ppr')
+
+    def stagedPath(self, name):
+        return self.paperDir(name) / Path(name + '.ppr.tmp')
+
+    def recover(self):
+        # redoes batches that were committed before a crash, files staged
+        # by one that never committed are dropped
+        for p in self.paperRoot().glob('*' + INTENT_SUFFIX + '.tmp'):
+            p.unlink()
+        for p in self.paperRoot().glob('*' + INTENT_SUFFIX):
+            try:
+                intent = json.loads(p.read_text())
+            except ValueError:
+                # not written by a batch, leave it alone
+                continue
+            self.applyBatch(intent, p)
+        for p in self.paperRoot().glob('*/' * self.depth + '*.ppr.tmp'):
+            p.unlink()
+
+    def applyBatch(self, intent, intent_path):
+        for name in intent['write']:
+            if self.stagedPath(name).exists():
+                os.replace(self.stagedPath(name), self.paperPath(name))
+        for name in intent['delete']:
+            self.paperPath(name).unlink(missing_ok=True)
+        names = intent['write'] + intent['delete']
+        for i in {self.paperDir(i) for i in names}:
+            syncDirectory(i)
+        intent_path.unlink()
+
+    @contextmanager
+    def batch(self):
+        if self.staged is not None:
+            yield
+            return
+
+        self.staged = {}
+        self.staged_dirs = {}
+        try:
+            yield
+            staged = self.staged
+            staged_dirs = self.staged_dirs
+        except BaseException:
+            for name, write in self.staged.items():
+                if write:
+                    self.stagedPath(name).unlink(missing_ok=True)
+            for path, valid in self.staged_dirs.items():
+                self.updateListing(path, valid)
+            raise
+        finally:
+            self.staged = None
+            self.staged_dirs = None
+
+        # the intent file is the commit point, every staged file is on
+        # disk before it is renamed into place
+        intent = {'write': [i for i in staged if staged[i]],
+                  'delete': [i for i in staged if not staged[i]]}
+        if staged:
+            # named per batch, other processes commit their own
+            intent_path = self.paperRoot() / Path(
+                os.urandom(8).hex() + INTENT_SUFFIX)
+            tmp_path = intent_path.with_name(intent_path.name + '.tmp')
+            with tmp_path.open('w') as f:
+                f.write(json.dumps(intent))
+                syncFile(f)
+            os.replace(tmp_path, intent_path)
+            syncDirectory(self.paperRoot())
+            self.applyBatch(intent, intent_path)
+        for path, valid in staged_dirs.items():
+            self.updateListing(
+                path, valid,
+                [i for i in intent['write'] if self.paperDir(i) == path],
+                [i for i in intent['delete'] if self.paperDir(i) == path])
+
+    def stageDir(self, name):
+        # notes whether the listing of the paper's directory is current
+        # before the batch changes it
+        path = self.paperDir(name)
+        if path not in self.staged_dirs:
+            self.staged_dirs[path] = self.listingValid(path)
+
+    def names(self):
+        names = []
+        for i in self.paperDirs():
+            names.extend(self.listDir(i))
+        return names
+
+    def listDir(self, path, dirs=False):
+        # papers or subdirectories of path, it is only scanned again when
+        # its mtime moved
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.listing.get(path)
+        if cached is None or cached[0] != mtime:
+            with os.scandir(path) as entries:
+                if dirs:
+                    found = {i.name for i in entries if i.is_dir()}
+                else:
+                    found = {i.name[:-4] for i in entries
+                             if i.name.endswith('.ppr') and i.is_file()}
+            cached = self.listing[path] = (mtime, found)
+        return cached[1]
+
+    def listingValid(self, path):
+        cached = self.listing.get(path)
+        return cached is not None and \
+            os.stat(path).st_mtime_ns == cached[0]
+
+    def updateListing(self, path, valid, added=(), removed=()):
+        # applies our own changes to a listing that was current before
+        # them, a stale one is left for the next scan
+        if valid:
+            found = self.listing[path][1]
+            found.update(added)
+            found.difference_update(removed)
+            self.listing[path] = (os.stat(path).st_mtime_ns, found)
+
+    def exists(self, name):
+        return self.paperPath(name).exists()
+
+    def version(self, name):
+        st = os.stat(self.paperPath(name))
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def watchDirs(self):
+        return [self.path]
+
+    def watchPaths(self, names):
+        # papers updated in place do not touch their directory
+        return [str(i) for i in self.watchDirs()] + \
+            [str(self.paperPath(i)) for i in names]
+
+    def open(self, name):
+        return self.paperPath(name).open('rb')
+
+    def view(self, name):
+        return mapFile(self.paperPath(name))
+
+    @contextmanager
+    def writer(self, name, partial=False):
+        path = self.paperPath(name)
+        if partial and self.staged is None:
+            # rewritten in place, there is no old copy to fall back on
+            with path.open('r+b') as f:
+                yield f
+                syncFile(f)
+            return
+
+        if self.depth:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.stagedPath(name)
+        if self.staged is not None:
+            self.stageDir(name)
+            valid = False
+        else:
+            valid = self.listingValid(path.parent)
+        try:
+            with tmp_path.open('wb') as f:
+                yield f
+                if self.staged is not None:
+                    syncFile(f)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            self.updateListing(path.parent, valid)
+            raise
+        if self.staged is not None:
+            self.staged[name] = True
+        else:
+            os.replace(tmp_path, path)
+            self.updateListing(path.parent, valid, [name])
+
+    def rename(self, name, rename):
+        path = self.paperPath(name)
+        rename_path = self.paperPath(rename)
+        if self.depth:
+            rename_path.parent.mkdir(parents=True, exist_ok=True)
+        valid = self.listingValid(path.parent)
+        rename_valid = self.listingValid(rename_path.parent)
+        path.rename(rename_path)
+        self.updateListing(path.parent, valid, removed=[name])
+        self.updateListing(rename_path.parent, rename_valid, [rename])
+
+    def delete(self, name):
+        # a paper another process removed first counts as deleted
+        path = self.paperPath(name)
+        if self.staged is None:
+            valid = self.listingValid(path.parent)
+            path.unlink(missing_ok=True)
+            self.updateListing(path.parent, valid, removed=[name])
+            return
+        self.stageDir(name)
+        if self.staged.get(name):
+            self.stagedPath(name).unlink()
+        self.staged[name] = False
+
+    def writeBlob(self, name, data):
+        valid = self.listingValid(self.path)
+        super().writeBlob(name, data)
+        self.updateListing(self.path, valid)
+
+    def deleteBlob(self, name):
+        valid = self.listingValid(self.path)
+        super().deleteBlob(name)
+        self.updateListing(self.path, valid)
+
+    def remove(self, blobs=True):
+        for name in self.names():
+            self.delete(name)
+        if blobs:
+            self.removeBlobs()
+
+
+class ShardedStorage(DirectoryStorage):
+    # .ppr files fanned out over two levels of directories named by a
+    # hash of the paper's id, e.g. papers/3f/a9/<id>.ppr
+    kind = 'sharded'
+    depth = 2
+
+    def __init__(self, path, name='papers'):
+        self.shard_path = path / Path(name)
+        if not self.shard_path.exists():
+            self.shard_path.mkdir()
+        super().__init__(path)
+
+    def paperRoot(self):
+        return self.shard_path
+
+    def paperDir(self, name):
+        digest = hashlib.blake2b(name.encode(), digest_size=2).hexdigest()
+        return self.shard_path / Path(digest[:2]) / Path(digest[2:])
+
+    def paperDirs(self):
+        dirs = []
+        for i in self.listDir(self.shard_path, True):
+            level = self.shard_path / Path(i)
+            dirs.extend(level / Path(j) for j in self.listDir(level, True))
+        return dirs
+
+    def install(self, name):
+        shard_path = self.path / Path(name)
+        os.replace(self.shard_path, shard_path)
+        self.shard_path = shard_path
+        self.listing = {}
+
+    def remove(self, blobs=True):
+        # moved aside first so a half removed tree is never opened
+        old_path = self.shard_path.with_name(self.shard_path.name + '.old')
+        os.replace(self.shard_path, old_path)
+        shutil.rmtree(old_path)
+        if blobs:
+            self.removeBlobs()
+
+
+class RecordReader:
+    # read only file over one record of the segment
+
+    def __init__(self, path, offset, length):
+        self.f = path.open('rb')
+        self.offset = offset
+        self.length = length
+        self.pos = 0
+
+    def read(self, size=-1):
+        left = self.length - self.pos
+        if size < 0 or size > left:
+            size = left
+        self.f.seek(self.offset + self.pos)
+        data = self.f.read(size)
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PackedStorage(FileStorage):
+    # papers are appended to one segment file, saves never rewrite
+    kind = 'packed'
+
+    def __init__(self, path, name='papers'):
+        super().__init__(path)
+        self.pack_path = path / Path(name + '.pack')
+        self.index_path = path / Path(name + '.idx')
+        self.index = {}
+        self.size = 0
+        self.dead = 0
+        self.unindexed = 0
+        # offset and index state the open batch rolls back to
+        self.begin = None
+        # segment file held locked while appending
+        self.append_file = None
+        self.load()
+
+    def load(self):
+        if not self.pack_path.exists():
+            generation = int.from_bytes(os.urandom(8), 'big')
+            self.pack_path.write_bytes(PACK_HEAD.pack(PACK_MAGIC, generation))
+        with self.pack_path.open('rb') as f:
+            magic, self.generation = PACK_HEAD.unpack(f.read(PACK_HEAD.size))
+        if magic != PACK_MAGIC:
+            raise ValueError("Unsupported pack version")
+
+        start = PACK_HEAD.size
+        if self.index_path.exists():
+            try:
+                data = json.loads(self.index_path.read_text())
+            except ValueError:
+                data = None
+            # an index left over from before a compaction is ignored
+            if data and data['generation'] == self.generation and \
+                    data['size'] <= self.pack_path.stat().st_size:
+                self.index = data['papers']
+                self.dead = data['dead']
+                start = data['size']
+        self.scan(start)
+
+    def scan(self, offset):
+        end = self.pack_path.stat().st_size
+        # offset and records of a batch that has not been committed yet
+        batch = None
+        with self.pack_path.open('rb') as f:
+            f.seek(offset)
+            while offset + RECORD_HEAD.size <= end:
+                head = f.read(RECORD_HEAD.size)
+                kind, name_len, length = RECORD_HEAD.unpack(head)
+                data_offset = offset + RECORD_HEAD.size + name_len
+                if kind not in (PUT, DELETE, RENAME, BEGIN, COMMIT) or \
+                        data_offset + length > end:
+                    break
+                name = f.read(name_len).decode()
+                rename = None
+                if kind == RENAME:
+                    rename = f.read(length).decode()
+                if kind == BEGIN:
+                    batch = (offset, [])
+                elif kind == COMMIT:
+                    for i in batch[1]:
+                        self.apply(*i)
+                    batch = None
+                elif batch is not None:
+                    batch[1].append((kind, name, data_offset, length, rename))
+                else:
+                    self.apply(kind, name, data_offset, length, rename)
+                offset = data_offset + length
+                f.seek(offset)
+
+        # a record torn by a crash or still being written by another
+        # process is left for appending() to drop under the lock
+        if batch is not None:
+            offset = batch[0]
+        self.size = offset
+
+    def refresh(self):
+        # another process may have appended records or compacted
+        with self.pack_path.open('rb') as f:
+            generation = PACK_HEAD.unpack(f.read(PACK_HEAD.size))[1]
+        size = self.pack_path.stat().st_size
+        if generation != self.generation or size < self.size:
+            self.index = {}
+            self.dead = 0
+            self.load()
+        elif size > self.size:
+            self.scan(self.size)
+
+    def apply(self, kind, name, offset, length, rename=None):
+        if kind == PUT:
+            version = 0
+            if name in self.index:
+                version = self.index[name][2]
+                self.dead += self.index[name][1]
+            self.index[name] = [offset, length, version + 1]
+        elif kind == DELETE:
+            if name in self.index:
+                self.dead += self.index.pop(name)[1]
+        elif kind == RENAME:
+            if name in self.index:
+                self.index[rename] = self.index.pop(name)
+
+    def saveIndex(self):
+        data = {'generation': self.generation,
+                'size': self.size,
+                'dead': self.dead,
+                'papers': self.index}
+        tmp_path = self.index_path.with_name(self.index_path.name + '.tmp')
+        tmp_path.write_text(json.dumps(data))
+        os.replace(tmp_path, self.index_path)
+        self.unindexed = 0
+
+    def names(self):
+        return list(self.index)
+
+    def exists(self, name):
+        return name in self.index
+
+    def version(self, name):
+        if name not in self.index:
+            raise FileNotFoundError(name)
+        # the counter survives compaction, offsets do not
+        return self.index[name][2]
+
+    def watchPaths(self, names):
+        return [str(self.path), str(self.pack_path)]
+
+    def open(self, name):
+        offset, length, version = self.index[name]
+        return RecordReader(self.pack_path, offset, length)
+
+    def view(self, name):
+        offset, length, version = self.index[name]
+        return mapFile(self.pack_path, offset, length)
+
+    @contextmanager
+    def appending(self):
+        # processes append one at a time, records another one added are
+        # scanned before ours are written after them
+        if self.append_file is not None:
+            yield
+            return
+
+        while True:
+            f = self.pack_path.open('rb')
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            # a compaction may have replaced the segment while we waited
+            if os.fstat(f.fileno()).st_ino == self.pack_path.stat().st_ino:
+                break
+            f.close()
+
+        self.append_file = f
+        try:
+            self.refresh()
+            if self.pack_path.stat().st_size > self.size:
+                # the tail a crashed writer left behind
+                with self.pack_path.open('r+b') as tail:
+                    tail.truncate(self.size)
+            yield
+        finally:
+            self.append_file = None
+            f.close()
+
+    @contextmanager
+    def record(self, kind, name, rename=None):
+        with self.appending():
+            with self.writeRecord(kind, name, rename) as f:
+                yield f
+
+    @contextmanager
+    def writeRecord(self, kind, name, rename=None):
+        # yields the segment positioned at the record data, the record
+        # stays pending until its length is filled in
+        name_b = name.encode()
+        with self.pack_path.open('r+b') as f:
+            f.seek(self.size)
+            f.write(RECORD_HEAD.pack(PENDING, len(name_b), 0) + name_b)
+            start = f.tell()
+            try:
+                yield f
+            except BaseException:
+                f.truncate(self.size)
+                raise
+            end = f.tell()
+            f.seek(self.size)
+            f.write(RECORD_HEAD.pack(kind, len(name_b), end - start))
+
+        self.size = end
+        self.apply(kind, name, start, end - start, rename)
+        self.unindexed += 1
+        # the index must not point past an uncommitted batch
+        if self.unindexed >= INDEX_INTERVAL and self.begin is None:
+            self.saveIndex()
+
+    @contextmanager
+    def batch(self):
+        if self.begin is not None:
+            yield
+            return
+
+        with self.appending():
+            self.begin = (self.size, dict(self.index), self.dead)
+            try:
+                with self.record(BEGIN, ''):
+                    pass
+                start = self.size
+                yield
+            except BaseException:
+                self.rollback()
+                raise
+            if self.size == start:
+                # nothing was written, the begin record is dropped again
+                self.rollback()
+                return
+
+            self.begin = None
+            with self.record(COMMIT, ''):
+                pass
+            with self.pack_path.open('r+b') as f:
+                syncFile(f)
+
+    def rollback(self):
+        self.size, self.index, self.dead = self.begin
+        self.begin = None
+        with self.pack_path.open('r+b') as f:
+            f.truncate(self.size)
+
+    @contextmanager
+    def writer(self, name, partial=False):
+        with self.record(PUT, name) as f:
+            yield f
+
+    def rename(self, name, rename):
+        with self.record(RENAME, name, rename) as f:
+            f.write(rename.encode())
+
+    def delete(self, name):
+        with self.record(DELETE, name):
+            pass
+
+    def install(self, name):
+        self.saveIndex()
+        pack_path = self.path / Path(name + '.pack')
+        index_path = self.path / Path(name + '.idx')
+        os.replace(self.index_path, index_path)
+        os.replace(self.pack_path, pack_path)
+        self.pack_path = pack_path
+        self.index_path = index_path
+
+    def remove(self, blobs=True):
+        os.remove(self.pack_path)
+        self.index_path.unlink(missing_ok=True)
+        if blobs:
+            self.removeBlobs()
+
+    def compact(self):
+        with self.appending():
+            self.compactSegment()
+
+    def compactSegment(self):
+        # copies the live records to a new segment, the generation
+        # changes so a stale index is never applied to it
+        tmp_path = self.pack_path.with_name(self.pack_path.name + '.tmp')
+        index = {}
+        generation = int.from_bytes(os.urandom(8), 'big')
+        with self.pack_path.open('rb') as src, tmp_path.open('wb') as dst:
+            dst.write(PACK_HEAD.pack(PACK_MAGIC, generation))
+            for name, (offset, length, version) in self.index.items():
+                name_b = name.encode()
+                dst.write(RECORD_HEAD.pack(PUT, len(name_b), length) + name_b)
+                index[name] = [dst.tell(), length, version]
+                src.seek(offset)
+                left = length
+                while left:
+                    data = src.read(min(left, COPY_SIZE))
+                    dst.write(data)
+                    left -= len(data)
+            size = dst.tell()
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, self.pack_path)
+
+        self.generation = generation
+        self.index = index
+        self.size = size
+        self.dead = 0
+        self.saveIndex()
+
+
+class SqliteStorage(Storage):
+    # one row per paper in papers.db, batches are single transactions
+    kind = 'sqlite'
+
+    def __init__(self, path, name='papers'):
+        self.path = path
+        self.db_path = path / Path(name + '.db')
+        # the connection is shared by the save worker and decrypt threads
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(str(self.db_path), isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS papers "
+                        "(name TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                        "version INTEGER NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS blobs "
+                        "(name TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        self.depth = 0
+
+    def query(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def names(self):
+        return [i[0] for i in self.query("SELECT name FROM papers")]
+
+    def exists(self, name):
+        return bool(self.query("SELECT 1 FROM papers WHERE name = ?", name))
+
+    def version(self, name):
+        rows = self.query("SELECT version FROM papers WHERE name = ?", name)
+        if not rows:
+            raise FileNotFoundError(name)
+        return rows[0][0]
+
+    def lockPath(self):
+        return self.path / Path('lock')
+
+    def watchPaths(self, names):
+        # commits land in the write-ahead log first
+        wal_path = self.db_path.with_name(self.db_path.name + '-wal')
+        return [str(self.db_path), str(wal_path)]
+
+    @contextmanager
+    def view(self, name):
+        rows = self.query("SELECT data FROM papers WHERE name = ?", name)
+        if not rows:
+            raise FileNotFoundError(name)
+        yield memoryview(rows[0][0])
+
+    @contextmanager
+    def writer(self, name, partial=False):
+        f = io.BytesIO()
+        yield f
+        self.query("INSERT INTO papers VALUES (?, ?, 1) "
+                   "ON CONFLICT(name) DO UPDATE "
+                   "SET data = excluded.data, version = version + 1",
+                   name, f.getbuffer())
+
+    def rename(self, name, rename):
+        self.query("UPDATE papers SET name = ? WHERE name = ?", rename, name)
+
+    def delete(self, name):
+        self.query("DELETE FROM papers WHERE name = ?", name)
+
+    def readBlob(self, name):
+        rows = self.query("SELECT data FROM blobs WHERE name = ?", name)
+        if rows:
+            return bytes(rows[0][0])
+        return None
+
+    def writeBlob(self, name, data):
+        self.query("INSERT OR REPLACE INTO blobs VALUES (?, ?)", name, data)
+
+    def deleteBlob(self, name):
+        self.query("DELETE FROM blobs WHERE name = ?", name)
+
+    @contextmanager
+    def batch(self):
+        # the lock is held so no other thread writes into the transaction
+        with self.lock:
+            self.depth += 1
+            if self.depth == 1:
+                self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                if self.depth == 1:
+                    self.db.execute("ROLLBACK")
+                raise
+            else:
+                if self.depth == 1:
+                    self.db.execute("COMMIT")
+            finally:
+                self.depth -= 1
+
+    def compact(self):
+        self.query("VACUUM")
+
+    def install(self, name):
+        self.close()
+        db_path = self.path / Path(name + '.db')
+        os.replace(self.db_path, db_path)
+        self.db_path = db_path
+
+    def remove(self, blobs=True):
+        self.close()
+        os.remove(self.db_path)
+        for suffix in ('-wal', '-shm'):
+            self.db_path.with_name(self.db_path.name + suffix).unlink(
+                missing_ok=True)
+
+    def close(self):
+        self.db.close()
+
+
+class MemoryStorage(Storage):
+    # nothing reaches the disk, for tests and benchmarks
+    kind = 'memory'
+
+    def __init__(self):
+        self.papers = {}
+        self.blobs = {}
+
+    def names(self):
+        return list(self.papers)
+
+    def exists(self, name):
+        return name in self.papers
+
+    @contextmanager
+    def view(self, name):
+        yield memoryview(self.papers[name])
+
+    @contextmanager
+    def writer(self, name, partial=False):
+        f = io.BytesIO()
+        yield f
+        self.papers[name] = f.getvalue()
+
+    def rename(self, name, rename):
+        self.papers[rename] = self.papers.pop(name)
+
+    def delete(self, name):
+        self.papers.pop(name, None)
+
+    def readBlob(self, name):
+        return self.blobs.get(name)
+
+    def writeBlob(self, name, data):
+        self.blobs[name] = bytes(data)
+
+    def deleteBlob(self, name):
+        self.blobs.pop(name, None)
+
+    @contextmanager
+    def batch(self):
+        papers = dict(self.papers)
+        try:
+            yield
+        except BaseException:
+            self.papers = papers
+            raise
+
+    def remove(self, blobs=True):
+        self.papers.clear()
+        if blobs:
+            self.blobs.clear()
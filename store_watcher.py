@@ -0,0 +1,35 @@
+import os
+
+from PyQt5.QtCore import QObject, QTimer, QFileSystemWatcher, pyqtSignal
+
+
+class StoreWatcher(QObject):
+    # emitted once the store has been quiet for delay ms after a change
+    changed = pyqtSignal()
+
+    def __init__(self, parent=None, delay=500):
+        super().__init__(parent)
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.touched)
+        self.watcher.directoryChanged.connect(self.touched)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.changed)
+
+    def touched(self, path):
+        self.timer.start()
+
+    def watch(self, paths):
+        # replaced files drop out of the watcher, so the paths are synced
+        # again after every reload
+        watched = set(self.watcher.files() + self.watcher.directories())
+        paths = set(i for i in paths if os.path.exists(i))
+        if watched - paths:
+            self.watcher.removePaths(list(watched - paths))
+        if paths - watched:
+            self.watcher.addPaths(list(paths - watched))
+
+    def stop(self):
+        self.timer.stop()
+        self.watch([])